@@ -1,51 +1,236 @@
-"""Flask App for Flask Cafe."""
+"""Flask App for Flask Cafe.
 
-from models import db, connect_db, Cafe, City, User, DEFAULT_USER_IMAGE_URL
+The app is built by create_app, with a config profile (see config.py):
+
+    flask --app app run
+    gunicorn "app:create_app('production')"
+"""
+
+from models import (
+    db, connect_db, city_cache, Cafe, Job, Like, User, DEFAULT_USER_IMAGE_URL)
 from forms import (CafeForm, SignupForm, LoginForm, ProfileEditForm)
+from worker import worker_command
+from cli import cafes_cli, images_cli, maps_cli
+from config import get_config
+from metrics import metrics
+from passwords import PasswordHasher, PoolSaturated, RETRY_AFTER
+from ratelimit import make_rate_limiter
+from cache import make_fragment_cache
+from markupsafe import Markup
+import mapping
 from sqlalchemy.exc import IntegrityError
-import os
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import namedtuple
+import hashlib
+import json
+import math
+import time
+
+from flask import (
+    Blueprint, Flask, current_app, render_template, redirect, flash, session,
+    jsonify, g, request, make_response, send_from_directory,
+    stream_with_context, url_for)
+
+
+views = Blueprint("views", __name__)
+
+
+def create_app(config=None):
+    """Create and return the Flask app.
+
+    config is a profile name ("development", "testing" or "production") or
+    a config class; by default, it's the FLASK_CONFIG environment variable
+    (or "development").
+    """
+
+    app = Flask(__name__)
+
+    app.config.from_object(get_config(config))
+
+    # take the client's IP from trusted proxies' X-Forwarded-For
+    if app.config['TRUSTED_PROXIES']:
+        hops = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    # only dev profile uses the toolbar; don't even import it otherwise
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
 
-from flask import Flask, render_template, redirect, flash, session, jsonify, g, request
-from flask_debugtoolbar import DebugToolbarExtension
+    connect_db(app)
 
+    app.extensions['fragment_cache'] = make_fragment_cache(app.config)
 
-app = Flask(__name__)
+    city_cache.ttl = app.config['CITY_CACHE_TTL']
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    "DATABASE_URL", 'postgresql:///flask_cafe')
-app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+    app.extensions['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_WORKERS'],
+        app.config['PASSWORD_QUEUE_DEPTH'],
+        app.config['BCRYPT_LOG_ROUNDS'])
 
-if app.debug:
-    app.config['SQLALCHEMY_ECHO'] = True
+    app.extensions['login_limiters'] = {
+        "ip": make_rate_limiter(
+            app.config, "login-ip", app.config['LOGIN_ATTEMPTS_PER_IP']),
+        "username": make_rate_limiter(
+            app.config, "login-username",
+            app.config['LOGIN_ATTEMPTS_PER_USERNAME']),
+    }
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.register_blueprint(views)
 
-toolbar = DebugToolbarExtension(app)
+    app.cli.add_command(worker_command)
+    app.cli.add_command(cafes_cli)
+    app.cli.add_command(maps_cli)
+    app.cli.add_command(images_cli)
+
+    return app
 
-connect_db(app)
 
 #######################################
 # auth & auth routes
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_INFO_KEY = "curr_user_info"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
-@app.before_request
+class SessionUser:
+    """The logged-in user, as cached in the (signed) session.
+
+    Holds just the fields most pages need (id, username, admin and name),
+    so most requests don't need to load the user from the database. Any
+    other attribute (like description or liked_cafes) loads the full User,
+    at most once per request.
+    """
+
+    FIELDS = ("id", "username", "admin", "first_name", "last_name")
+
+    def __init__(self, info):
+        self._user = None
+
+        for field in self.FIELDS:
+            setattr(self, field, info[field])
+
+    def __getattr__(self, name):
+        # only called for attributes not cached in the session
+        return getattr(self.load(), name)
+
+    @classmethod
+    def fetch_info(cls, user_id):
+        """Get session info for this user (without loading the full row),
+        or None if there is no such user."""
+
+        columns = [getattr(User, field) for field in cls.FIELDS]
+        row = db.session.execute(
+            db.select(*columns).where(User.id == user_id)).first()
+
+        if row is None:
+            return None
+
+        return {**row._asdict(), "loaded_at": time.time()}
+
+    def get_full_name(self):
+        """ Returns a string of “FIRSTNAME LASTNAME” """
+
+        return (f"{self.first_name} {self.last_name}")
+
+    def load(self):
+        """Return the full User for this user."""
+
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+
+        return self._user
+
+
+# endpoints that never load the current user from the database
+# (views can also opt out with @skip_user_load)
+SKIP_USER_LOAD_ENDPOINTS = {"static"}
+
+
+def skip_user_load(view):
+    """Mark view as never loading the current user from the database.
+
+    g.user is still set from the user info cached in the session, if any,
+    so the navbar works; it's just never refreshed for these views.
+    """
+
+    view.skip_user_load = True
+
+    return view
+
+
+def is_user_load_skipped():
+    """Return True if this request shouldn't load the user from the db."""
+
+    # no endpoint means no route matched (a 404)
+    if request.endpoint is None or request.endpoint in SKIP_USER_LOAD_ENDPOINTS:
+        return True
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    return getattr(view, "skip_user_load", False)
+
+
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Uses the user info cached in the session while it's fresh (see
+    SESSION_USER_TTL), else refreshes it.
+    """
 
-    else:
+    if CURR_USER_KEY not in session:
         g.user = None
+        return
+
+    info = session.get(CURR_USER_INFO_KEY)
+
+    if is_user_load_skipped():
+        if info and info["id"] == session[CURR_USER_KEY]:
+            g.user = SessionUser(info)
+        else:
+            g.user = None
+
+        return
+
+    ttl = current_app.config['SESSION_USER_TTL']
+
+    if (not info
+            or info["id"] != session[CURR_USER_KEY]
+            or info["loaded_at"] + ttl < time.time()):
+        info = SessionUser.fetch_info(session[CURR_USER_KEY])
+        session[CURR_USER_INFO_KEY] = info
+
+    g.user = SessionUser(info) if info else None
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_INFO_KEY] = SessionUser.fetch_info(user.id)
+
+
+def throttle_login(username):
+    """Count a login attempt against the client's IP and the username.
+
+    Returns 0 if the attempt may go ahead, else seconds until it may (and
+    counts it in metric "login.throttled.ip" or "login.throttled.username").
+    """
+
+    limiters = current_app.extensions['login_limiters']
+
+    for name, key in [("ip", request.remote_addr),
+                      ("username", username.lower())]:
+        delay = limiters[name].take(key)
+
+        if delay:
+            metrics.incr(f"login.throttled.{name}")
+            return delay
+
+    return 0
 
 
 def do_logout():
@@ -54,56 +239,206 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_INFO_KEY, None)
+
 
 #######################################
 # homepage
 
-@app.get("/")
+@views.get("/")
+@skip_user_load
 def homepage():
     """Show homepage."""
 
     return render_template("homepage.html")
 
 
+@views.get("/health")
+@skip_user_load
+def health():
+    """Health check for load balancers; doesn't touch the database."""
+
+    return jsonify(status="ok")
+
+
+@views.get("/metrics")
+@skip_user_load
+def show_metrics():
+    """Return this process's metrics (see metrics.py) as JSON."""
+
+    return jsonify(metrics.snapshot())
+
+
 #######################################
 # cafes
 
 
-@app.get('/cafes')
+def render_cafe_card(cafe):
+    """Render cafe's card for the list page.
+
+    Cards are cached by the cafe's id and version (bumped whenever the
+    cafe changes), when its city last changed (cards show the city's name),
+    and the release (so a deploy's new template isn't masked).
+    """
+
+    city = city_cache.get(cafe.city_code)
+    release = current_app.config['RELEASE']
+
+    html = current_app.extensions['fragment_cache'].get_or_render(
+        f"cafe-card:{release}:{cafe.id}:{cafe.version}:"
+        f"{city.updated_at.timestamp()}",
+        lambda: render_template("cafe/_card.html", cafe=cafe),
+    )
+
+    return Markup(html)
+
+
+def conditional_page(stamp, last_modified, render):
+    """Return response of render(), supporting conditional GETs.
+
+    Pages for anonymous users are the same for everyone, so they get a weak
+    ETag (a hash of stamp, which must change whenever the page would) and
+    Last-Modified; if the browser's copy is still current, this returns 304
+    without calling render. Pages for logged-in users (or with flashed
+    messages) are never cached.
+    """
+
+    if g.user or session.get("_flashes"):
+        response = make_response(render())
+        response.cache_control.private = True
+        response.cache_control.no_store = True
+        response.vary.add("Cookie")
+        return response
+
+    etag = hashlib.sha1(
+        repr((current_app.config['RELEASE'], stamp)).encode("UTF-8"),
+    ).hexdigest()
+
+    if is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified):
+        response = make_response(render())
+    else:
+        response = current_app.response_class(status=304)
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # caches may store it, but must check it's current before using it
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+
+    return response
+
+
+CafePage = namedtuple("CafePage", [
+    "cafes", "has_prev", "has_next", "prev_url", "next_url", "city_code",
+    "sort"])
+
+
+def get_cafe_page(endpoint, **url_args):
+    """Return the CafePage asked for by ?city, ?sort, ?after and ?before.
+
+    Its prev/next URLs point to endpoint, with the same city and sort (plus
+    url_args).
+    """
+
+    city_code = request.args.get('city') or None
+    sort = request.args.get('sort')
+
+    if sort not in Cafe.SORTS:
+        sort = "name"
+
+    cafes, has_prev, has_next = Cafe.get_page(
+        current_app.config['CAFES_PER_PAGE'],
+        after=Cafe.parse_cursor(request.args.get('after'), sort),
+        before=Cafe.parse_cursor(request.args.get('before'), sort),
+        city_code=city_code,
+        sort=sort,
+    )
+
+    prev_url = next_url = None
+    url_args = dict(city=city_code, sort=sort, **url_args)
+
+    if has_prev and cafes:
+        prev_url = url_for(
+            endpoint, before=cafes[0].get_cursor(sort), **url_args)
+
+    if has_next and cafes:
+        next_url = url_for(
+            endpoint, after=cafes[-1].get_cursor(sort), **url_args)
+
+    return CafePage(
+        cafes, has_prev, has_next, prev_url, next_url, city_code, sort)
+
+
+@views.get('/cafes')
 def cafe_list():
-    """Return list of all cafes."""
+    """Return a page of cafes, optionally only those in ?city=CODE.
 
-    cafes = Cafe.query.order_by('name').all()
+    Sort with ?sort=name (default) or ?sort=likes (most liked first).
+    Paginate with ?after=CURSOR / ?before=CURSOR (see Cafe.get_cursor).
+    """
 
-    return render_template(
+    cafes, has_prev, has_next, prev_url, next_url, city_code, sort = (
+        get_cafe_page('.cafe_list'))
+
+    # the page shows these cafes, plus every city (in the city filter)
+    cities = city_cache.get_all().values()
+    stamp = (request.full_path,
+             [(cafe.id, cafe.version) for cafe in cafes],
+             has_prev, has_next,
+             [(city.code, city.updated_at) for city in cities])
+    last_modified = max(
+        [cafe.updated_at for cafe in cafes]
+        + [city.updated_at for city in cities],
+        default=None)
+
+    return conditional_page(stamp, last_modified, lambda: render_template(
         'cafe/list.html',
         cafes=cafes,
+        cities=get_city_choices(),
+        city_code=city_code,
+        sort=sort,
+        prev_url=prev_url,
+        next_url=next_url,
+        render_cafe_card=render_cafe_card,
         user=g.user
-    )
+    ))
 
 
-@app.get('/cafes/<int:cafe_id>')
+@views.get('/cafes/<int:cafe_id>')
 def cafe_detail(cafe_id):
     """Show detail for cafe."""
 
-    liked_cafes = []
+    liked = False
     cafe = Cafe.query.get_or_404(cafe_id)
 
-    map_url = cafe.get_cafe_map()
+    # maps are rendered by the worker; show a placeholder until it's ready
+    map_url = cafe.get_cached_map()
+
+    if not map_url:
+        # a map that failed for good isn't retried on every page view (and
+        # MapQuest call); editing the cafe's location queues a new one
+        Job.enqueue("map", cafe.id, retry_failed=False)
+        db.session.commit()
 
     if g.user:
-        liked_cafes = [c.id for c in g.user.liked_cafes]
+        liked = Like.is_liked(g.user.id, cafe.id)
+
+    city = cafe.get_city()
+    stamp = (cafe.id, cafe.version, city.updated_at, map_url)
+    last_modified = max(cafe.updated_at, city.updated_at)
 
-    return render_template(
+    return conditional_page(stamp, last_modified, lambda: render_template(
         'cafe/detail.html',
         cafe=cafe,
         user=g.user,
-        liked_cafes=liked_cafes,
+        liked=liked,
         map_url=map_url
-    )
+    ))
 
 
-@app.route('/cafes/add', methods=["GET", "POST"])
+@views.route('/cafes/add', methods=["GET", "POST"])
 def add_cafe():
     """Add a cafe:
 
@@ -138,7 +473,10 @@ def add_cafe():
 
             db.session.flush()
 
-            cafe.get_cafe_map()
+            Job.enqueue("map", cafe.id)
+
+            if image_url:
+                Job.enqueue("cafe_image", cafe.id)
 
             db.session.commit()
 
@@ -147,12 +485,15 @@ def add_cafe():
             return redirect(f"/cafes/{cafe.id}")
 
     except IntegrityError:
+        # e.g. there's already a cafe with this name at this address
+        db.session.rollback()
+        flash("That cafe already exists.", "danger")
         return render_template("/cafe/add-form.html", form=form)
 
     return render_template("/cafe/add-form.html", form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@views.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def edit_cafe(cafe_id):
     """ Edit a cafe:
 
@@ -171,6 +512,9 @@ def edit_cafe(cafe_id):
         # breakpoint()
         if form.validate_on_submit():
             # breakpoint()
+            old_map_key = cafe.get_map_key()
+            old_image_url = cafe.image_url
+
             cafe.name = form.name.data
             cafe.description = form.description.data
             cafe.url = form.url.data
@@ -178,6 +522,12 @@ def edit_cafe(cafe_id):
             cafe.city_code = form.city_code.data
             cafe.image_url = form.image.data or DEFAULT_USER_IMAGE_URL
 
+            if cafe.get_map_key() != old_map_key:
+                Job.enqueue("map", cafe.id)
+
+            if cafe.image_url != old_image_url:
+                Job.enqueue("cafe_image", cafe.id)
+
             db.session.commit()
 
             flash(f"{cafe.name} edited", "info")
@@ -186,6 +536,7 @@ def edit_cafe(cafe_id):
 
     except IntegrityError:
         db.session.rollback()
+        flash("That cafe already exists.", "danger")
 
         # return render_template("/cafe/add-form.html", form=form)
 
@@ -194,17 +545,51 @@ def edit_cafe(cafe_id):
 
 
 def get_city_choices():
-    """Get choices for cities' select field. Return list of cities"""
+    """Get choices for cities' select field. Return list of cities
+
+    Cities come from the city cache, so this doesn't usually query the db.
+    """
 
-    cities = [(c.code, c.name) for c in City.query.all()]
+    cities = [(c.code, c.name) for c in city_cache.get_all().values()]
 
     return cities
 
 
+@views.get('/maps/<map_key>.jpg')
+@skip_user_load
+def show_map(map_key):
+    """Serve a saved cafe map.
+
+    A map's URL is versioned by a hash of its content (see get_map_path),
+    so it's cached as immutable; the hash is also its ETag, so
+    revalidations get a 304 without the image. Requests for any other
+    version get the current map, which caches must revalidate.
+    """
+
+    version = mapping.get_map_version(map_key)
+
+    response = send_from_directory(
+        mapping.MAPS_DIR,
+        f"{map_key}.jpg",
+        max_age=current_app.config['MAP_MAX_AGE'],
+        etag=version or True,
+    )
+
+    response.cache_control.public = True
+
+    if request.args.get('v') == version:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+
+    return response
+
+
 #######################################
 # users
 
-@app.get('/profile')
+@views.get('/profile')
 def show_profile():
     """ Show user's profile page """
 
@@ -212,10 +597,10 @@ def show_profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect('/login')
 
-    return render_template("/profile/detail.html", user=g.user)
+    return render_template("/profile/detail.html", user=g.user.load())
 
 
-@app.route("/signup", methods=['GET', 'POST'])
+@views.route("/signup", methods=['GET', 'POST'])
 def signup():
     """ Handle user signup.
 
@@ -242,6 +627,9 @@ def signup():
                 password=form.password.data,
                 image_url=form.image_url.data or None,
             )
+            db.session.flush()
+
+            Job.enqueue("user_image", user.id)
             # breakpoint()
             db.session.commit()
 
@@ -260,19 +648,32 @@ def signup():
         return render_template("/auth/signup-form.html", form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login():
     """ Handles login and redirects to cafe list on success  """
 
     form = LoginForm()
 
     if form.validate_on_submit():
+        # before the password is checked, so floods can't burn our CPU
+        delay = throttle_login(form.username.data)
+
+        if delay:
+            return (
+                "Too many login attempts; please try again later.",
+                429,
+                {"Retry-After": str(math.ceil(delay))},
+            )
+
         user = User.authenticate(
             form.username.data,
             form.password.data
         )
 
         if user:
+            # save the password's new hash, if it was rehashed
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}", "success")
 
@@ -287,7 +688,7 @@ def login():
         return render_template("auth/login-form.html", form=form)
 
 
-@app.post('/logout')
+@views.post('/logout')
 def logout():
     """ Handle logout of user and redirect to homepage. """
 
@@ -301,7 +702,7 @@ def logout():
     return redirect("/")
 
 
-@app.route('/profile/edit', methods=['GET', 'POST'])
+@views.route('/profile/edit', methods=['GET', 'POST'])
 def edit_profile():
     """Update profile for current user.
 
@@ -312,7 +713,7 @@ def edit_profile():
         flash("Access unauthorized.", "danger")
         return redirect("/profile")
 
-    user = g.user
+    user = g.user.load()
     form = ProfileEditForm(obj=user)
 
     if form.validate_on_submit():
@@ -323,8 +724,12 @@ def edit_profile():
         user.image_url = form.image_url.data or DEFAULT_USER_IMAGE_URL,
         user.admin = True
 
+        # a no-op for the worker if the image is unchanged
+        Job.enqueue("user_image", user.id)
+
         try:
             db.session.commit()
+            do_login(user)
             flash("Profile edited", 'success')
 
             return redirect('/profile')
@@ -343,7 +748,88 @@ def edit_profile():
 # liked cafes
 
 
-@app.get('/api/likes')
+def get_api_fields():
+    """Return fields of cafes asked for by ?fields=a,b (None for all).
+
+    Raises ValueError if any isn't in Cafe.API_FIELDS.
+    """
+
+    fields = request.args.get('fields')
+
+    if not fields:
+        return None
+
+    # id is always included; ignore it, and empty items ("name,")
+    fields = [field for field in fields.split(",") if field not in ("", "id")]
+    unknown = set(fields) - set(Cafe.API_FIELDS)
+
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return fields
+
+
+@views.get('/api/cafes')
+@skip_user_load
+def api_cafes():
+    """Return a page of cafes as JSON:
+
+        {"cafes": [{"id": 1, "name": ...}, ...], "prev": URL, "next": URL}
+
+    Takes ?city, ?sort, ?after and ?before like the cafe list page, and
+    ?fields=name,city to return just those fields (plus id).
+
+    With ?format=ndjson, streams every cafe (in ?city, if given) instead,
+    one JSON object per line, in id order.
+    """
+
+    try:
+        fields = get_api_fields()
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    city_code = request.args.get('city') or None
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for cafe in Cafe.stream(city_code):
+                yield json.dumps(cafe.to_dict(fields)) + "\n"
+
+        return current_app.response_class(
+            stream_with_context(generate()),
+            mimetype="application/x-ndjson")
+
+    page = get_cafe_page('.api_cafes', fields=request.args.get('fields'))
+
+    return jsonify(
+        cafes=[cafe.to_dict(fields) for cafe in page.cafes],
+        prev=page.prev_url,
+        next=page.next_url,
+    )
+
+
+@views.get('/api/cafes/<int:cafe_id>')
+@skip_user_load
+def api_cafe(cafe_id):
+    """Return cafe as JSON: {"cafe": {"id": 1, "name": ...}}.
+
+    Takes ?fields=name,city to return just those fields (plus id).
+    """
+
+    try:
+        fields = get_api_fields()
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    cafe = db.session.get(Cafe, cafe_id)
+
+    if cafe is None:
+        return jsonify(error="Not found"), 404
+
+    return jsonify(cafe=cafe.to_dict(fields))
+
+
+@views.get('/api/likes')
 def cafe_is_liked():
     """ Given cafe_id in the URL query string,
       figure out if the current user likes that cafe,
@@ -352,67 +838,99 @@ def cafe_is_liked():
     user_id = int(request.args.get('userId'))
     cafe_id = int(request.args.get('cafeId'))
 
-    likes = False
-
-    user = User.query.get_or_404(user_id)
-
-    if cafe_id in [c.id for c in user.liked_cafes]:
-        likes = True
+    likes = Like.is_liked(user_id, cafe_id)
 
     return jsonify(likes=likes)
 
 
-@app.post('/api/like')
+@views.post('/api/like')
 def like_cafe():
-    """ Given JSON e.g.{"cafe_id": 1}, make the current user like cafe #1 """
+    """ Given JSON e.g.{"cafeId": 1, "userId": 1}, make user like cafe #1.
+
+    Liking an already-liked cafe is a no-op.
+    Return JSON: {"liked": 1, "likes": true}
+    """
 
     data = request.json
 
     cafe_id = data['cafeId']
     user_id = data['userId']
 
-    user = User.query.get_or_404(user_id)
-
-    if not user:
-        return jsonify(error="Not logged in")
-
-    else:
-        cafe = Cafe.query.get_or_404(cafe_id)
-        user.liked_cafes.append(cafe)
-
+    try:
+        Like.add(user_id, cafe_id)
         db.session.commit()
 
-        return jsonify(liked=cafe_id)
+    except IntegrityError:
+        # no such user or cafe
+        db.session.rollback()
+        return jsonify(error="Not found"), 404
+
+    return jsonify(liked=cafe_id, likes=True)
 
 
-@app.post('/api/unlike')
+@views.post('/api/unlike')
 def unlike_cafe():
-    """ Given JSON e.g.{"cafe_id": 1}, make the current user like cafe #1 """
+    """ Given JSON e.g.{"cafeId": 1, "userId": 1}, make user unlike cafe #1.
+
+    Unliking a cafe that isn't liked is a no-op.
+    Return JSON: {"unliked": 1, "likes": false}
+    """
 
     data = request.json
 
     cafe_id = data['cafeId']
     user_id = data['userId']
 
-    user = User.query.get_or_404(user_id)
+    Like.remove(user_id, cafe_id)
+    db.session.commit()
 
-    if not user:
-        return jsonify(error="Not logged in")
+    return jsonify(unliked=cafe_id, likes=False)
 
-    else:
-        cafe = Cafe.query.get_or_404(cafe_id)
-        user.liked_cafes.remove(cafe)
 
+@views.post('/api/likes/toggle')
+def toggle_like():
+    """ Given JSON e.g.{"cafeId": 1}, flip whether the logged-in user
+    likes cafe #1.
+
+    Return JSON with the new state and the cafe's like count,
+    e.g. {"likes": true, "likeCount": 3}, or a 401 if not logged in.
+    """
+
+    if not g.user:
+        return jsonify(error=NOT_LOGGED_IN_MSG), 401
+
+    cafe_id = request.json['cafeId']
+    user_id = g.user.id
+
+    try:
+        likes = Like.toggle(user_id, cafe_id)
+        like_count = Like.count_for(cafe_id)
         db.session.commit()
 
-        return jsonify(unliked=cafe_id)
+    except IntegrityError:
+        # no such user or cafe
+        db.session.rollback()
+        return jsonify(error="Not found"), 404
+
+    return jsonify(likes=likes, likeCount=like_count)
 
 #######################################
 # 404 page
 
 
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def page_not_found(error):
     """ Return 404 page """
 
     return render_template('/404.html'), 404
+
+
+@views.app_errorhandler(PoolSaturated)
+def password_pool_saturated(error):
+    """Too many logins/signups at once: ask the client to retry shortly."""
+
+    return (
+        "Too many requests right now; please try again shortly.",
+        503,
+        {"Retry-After": str(RETRY_AFTER)},
+    )
@@ -0,0 +1,81 @@
+"""Benchmarks for Flask Cafe.
+
+Measures, for each config profile, how long importing the app and running
+create_app takes, and the per-request overhead of pages that don't touch
+the database (so no database is needed):
+
+    python benchmark.py [REQUESTS]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+from app import create_app
+
+PROFILES = ["development", "production"]
+STARTUP_RUNS = 5
+PATHS = ["/", "/health"]
+
+STARTUP_CODE = """
+import time
+start = time.perf_counter()
+import app
+app.create_app({profile!r})
+print(time.perf_counter() - start)
+"""
+
+
+def time_startup(profile):
+    """Return median seconds to import app and create it, in a fresh
+    interpreter each run."""
+
+    times = []
+
+    for _ in range(STARTUP_RUNS):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_CODE.format(profile=profile)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times.append(float(out.stdout))
+
+    return statistics.median(times)
+
+
+def time_requests(profile, path, count):
+    """Return mean seconds per GET of path."""
+
+    app = create_app(profile)
+
+    # the toolbar only kicks in for debug apps, as under `flask run --debug`
+    app.debug = app.config['DEBUG_TB_ENABLED']
+
+    with app.test_client() as client:
+        # warm up (template compilation, etc)
+        client.get(path)
+
+        start = time.perf_counter()
+
+        for _ in range(count):
+            client.get(path)
+
+        return (time.perf_counter() - start) / count
+
+
+def main(count=500):
+    """Print benchmark results for every profile."""
+
+    for profile in PROFILES:
+        print(f"{profile}:")
+        print(f"  import + create_app: {time_startup(profile) * 1000:.1f} ms")
+
+        for path in PATHS:
+            per_request = time_requests(profile, path, count)
+            print(f"  GET {path}: {per_request * 1_000_000:.0f} us/request")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
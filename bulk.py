@@ -0,0 +1,217 @@
+"""Bulk import and export of cafes, as CSV or NDJSON.
+
+Imports are streamed into a temporary staging table with postgres COPY,
+then merged into cafes by a single upsert keyed on (name, address,
+city_code), so even large files load in seconds. Maps and thumbnails for
+new or changed cafes are left to the worker.
+
+CSV files have a header row naming their columns; NDJSON files have one
+JSON object per line. Either way, the fields are those in COLUMNS.
+"""
+
+import csv
+import json
+
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from images import get_image_key
+from models import db, Cafe, Job
+
+# fields of imported/exported cafes; all but image_url are required
+COLUMNS = ("name", "description", "url", "address", "city_code", "image_url")
+REQUIRED_COLUMNS = COLUMNS[:-1]
+
+FORMATS = ("csv", "ndjson")
+
+# rows fetched at a time when exporting NDJSON
+BATCH_SIZE = 1000
+
+# staging tables live until the import's transaction ends; "line" keeps the
+# order rows were read in, so a cafe listed twice gets its last values
+csv_staging = db.Table(
+    "cafes_import",
+    db.MetaData(),
+    db.Column("line", db.BigInteger, db.Identity()),
+    *[db.Column(column, db.Text) for column in COLUMNS],
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+ndjson_staging = db.Table(
+    "cafes_import_ndjson",
+    db.MetaData(),
+    db.Column("line", db.BigInteger, db.Identity()),
+    db.Column("doc", JSONB),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+def get_format(filename):
+    """Guess format of file from its name: NDJSON for .ndjson/.jsonl,
+    else CSV."""
+
+    if filename.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+
+    return "csv"
+
+
+def copy_from(file, sql):
+    """Run COPY ... FROM STDIN statement sql, reading from file."""
+
+    with db.session.connection().connection.cursor() as cursor:
+        cursor.copy_expert(sql, file)
+
+
+def stage_csv(file):
+    """COPY CSV file into the CSV staging table; return the rows as a
+    subquery.
+
+    Raises ValueError if the header has unknown, missing or repeated
+    columns.
+    """
+
+    header = next(csv.reader([file.readline()]), [])
+
+    unknown = set(header) - set(COLUMNS)
+    missing = set(REQUIRED_COLUMNS) - set(header)
+    repeated = {column for column in header if header.count(column) > 1}
+
+    if unknown or missing or repeated:
+        raise ValueError(
+            f"Bad CSV header: unknown {sorted(unknown)}, missing "
+            f"{sorted(missing)}, repeated {sorted(repeated)}")
+
+    csv_staging.create(db.session.connection())
+    copy_from(
+        file,
+        f"COPY cafes_import ({', '.join(header)}) FROM STDIN (FORMAT csv)")
+
+    return db.select(csv_staging).subquery()
+
+
+def stage_ndjson(file):
+    """COPY NDJSON file into the NDJSON staging table; return the rows
+    (with a column per field) as a subquery."""
+
+    ndjson_staging.create(db.session.connection())
+
+    # CSV format, with quote & delimiter characters JSON can't contain, so
+    # each line arrives untouched (text format would eat backslashes)
+    copy_from(
+        file,
+        "COPY cafes_import_ndjson (doc) FROM STDIN "
+        "(FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')")
+
+    doc = ndjson_staging.c.doc
+
+    return (db.select(
+                ndjson_staging.c.line,
+                *[doc[column].astext.label(column) for column in COLUMNS])
+            .where(doc.is_not(None))
+            .subquery())
+
+
+def upsert_cafes(rows):
+    """Add cafes from staged rows, or update those that already exist.
+
+    Only rows that change something are written. Returns (id, map_key,
+    image_key, image_url) of every cafe added or changed.
+    """
+
+    key = [rows.c.name, rows.c.address, rows.c.city_code]
+
+    latest = (db.select(*[rows.c[column] for column in COLUMNS])
+              .distinct(*key)
+              .order_by(*key, rows.c.line.desc())
+              .subquery())
+
+    values = db.select(
+        *[latest.c[column] for column in REQUIRED_COLUMNS],
+        db.func.coalesce(latest.c.image_url, Cafe.image_url.default.arg),
+    )
+
+    stmt = insert(Cafe).from_select(COLUMNS, values)
+
+    updates = ["description", "url", "image_url"]
+
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_cafes_name_address_city_code",
+        set_={
+            **{column: stmt.excluded[column] for column in updates},
+            "version": Cafe.version + 1,
+            "updated_at": stmt.excluded.updated_at,
+        },
+        where=db.or_(*[
+            getattr(Cafe, column).is_distinct_from(stmt.excluded[column])
+            for column in updates
+        ]),
+    )
+
+    return db.session.execute(stmt.returning(
+        Cafe.id, Cafe.map_key, Cafe.image_key, Cafe.image_url)).all()
+
+
+def import_cafes(file, format="csv"):
+    """Import cafes from (text) file, in this format ("csv" or "ndjson").
+
+    Queues map jobs for new cafes, and thumbnail jobs for new images
+    (rows without an image_url have none). Caller commits.
+
+    Returns number of cafes added or changed. Raises ValueError for a bad
+    CSV header, psycopg2.Error if postgres can't parse the file, or
+    IntegrityError if a row lacks a required field or has an unknown city.
+    """
+
+    if format == "ndjson":
+        rows = stage_ndjson(file)
+    else:
+        rows = stage_csv(file)
+
+    cafes = upsert_cafes(rows)
+
+    Job.enqueue_many(
+        "map", [cafe.id for cafe in cafes if cafe.map_key is None])
+
+    # rows without an image_url got the default image; nothing to fetch
+    default_image_url = Cafe.image_url.default.arg
+
+    Job.enqueue_many("cafe_image", [
+        cafe.id for cafe in cafes
+        if cafe.image_url != default_image_url
+        and cafe.image_key != get_image_key(cafe.image_url)
+    ])
+
+    return len(cafes)
+
+
+def export_cafes(file, format="csv"):
+    """Write every cafe (in id order) to (text) file, in this format
+    ("csv" or "ndjson"). Returns number of cafes written.
+
+    CSV is written by postgres COPY; NDJSON is fetched BATCH_SIZE rows at
+    a time from a server-side cursor.
+    """
+
+    query = (db.select(*[getattr(Cafe, column) for column in COLUMNS])
+             .order_by(Cafe.id))
+
+    if format == "csv":
+        connection = db.session.connection()
+        sql = query.compile(dialect=connection.dialect)
+
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY ({sql}) TO STDOUT (FORMAT csv, HEADER true)", file)
+
+            return cursor.rowcount
+
+    count = 0
+
+    for row in db.session.execute(
+            query.execution_options(yield_per=BATCH_SIZE)):
+        file.write(json.dumps(row._asdict()) + "\n")
+        count += 1
+
+    return count
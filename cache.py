@@ -0,0 +1,100 @@
+"""Caches for rendered HTML fragments (see FragmentCache).
+
+The in-process LRUCache is the default; set FRAGMENT_CACHE_URL to a
+redis:// URL to share one cache between processes (needs the redis
+package). Any object with get(key) and set(key, value) will do as a
+backend.
+"""
+
+from collections import OrderedDict
+import threading
+
+from metrics import metrics
+
+
+class LRUCache:
+    """In-process cache of up to maxsize items, least recently used
+    dropped first. Thread-safe."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return value for key, or None."""
+
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return None
+
+            return self._items[key]
+
+    def set(self, key, value):
+        """Store value for key."""
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+class RedisCache:
+    """Cache shared between processes, in redis. Items expire after
+    timeout seconds."""
+
+    def __init__(self, url, timeout=24 * 60 * 60):
+        # optional dependency; only needed if this backend is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.timeout = timeout
+
+    def get(self, key):
+        """Return value for key, or None."""
+
+        value = self.client.get(key)
+
+        return value.decode("UTF-8") if value is not None else None
+
+    def set(self, key, value):
+        """Store value for key."""
+
+        self.client.set(key, value.encode("UTF-8"), ex=self.timeout)
+
+
+class FragmentCache:
+    """Cache of rendered HTML, counting hits and misses in metrics
+    ("fragment_cache.hits" / "fragment_cache.misses")."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_or_render(self, key, render):
+        """Return cached HTML for key, else call render() and cache that."""
+
+        html = self.backend.get(key)
+
+        if html is not None:
+            metrics.incr("fragment_cache.hits")
+            return html
+
+        metrics.incr("fragment_cache.misses")
+
+        html = render()
+        self.backend.set(key, html)
+
+        return html
+
+
+def make_fragment_cache(config):
+    """Return FragmentCache with the backend this app config asks for."""
+
+    if config['FRAGMENT_CACHE_URL']:
+        return FragmentCache(RedisCache(config['FRAGMENT_CACHE_URL']))
+
+    return FragmentCache(LRUCache(config['FRAGMENT_CACHE_SIZE']))
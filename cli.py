@@ -0,0 +1,128 @@
+"""Flask CLI commands for Flask Cafe.
+
+Run with e.g.:
+
+    flask --app app cafes recount-likes
+    flask --app app cafes import cafes.csv
+    flask --app app cafes export cafes.ndjson
+    flask --app app maps regenerate
+    flask --app app maps gc
+    flask --app app images backfill
+"""
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import psycopg2
+from sqlalchemy.exc import DBAPIError
+
+from bulk import FORMATS, export_cafes, get_format, import_cafes
+from models import db, Cafe
+from worker import collect_map_garbage, queue_thumbnails, regenerate_maps
+
+cafes_cli = AppGroup("cafes", help="Manage cafes.")
+maps_cli = AppGroup("maps", help="Manage cafe maps.")
+images_cli = AppGroup("images", help="Manage cafe and user thumbnails.")
+
+
+@cafes_cli.command("recount-likes")
+def recount_likes_command():
+    """Recompute every cafe's like count from the likes table."""
+
+    count = Cafe.recount_likes()
+    db.session.commit()
+
+    click.echo(f"Fixed like count for {count} cafe(s).")
+
+
+@cafes_cli.command("import")
+@click.argument("file", type=click.File("r", encoding="UTF-8"))
+@click.option(
+    "--format",
+    type=click.Choice(FORMATS),
+    help="File format (default: from its name; CSV unless .ndjson/.jsonl).")
+def import_cafes_command(file, format):
+    """Add cafes from FILE ("-" for stdin), or update matching ones.
+
+    Cafes are matched by name, address and city_code. Maps and thumbnails
+    are made by the worker.
+    """
+
+    try:
+        count = import_cafes(file, format or get_format(file.name))
+        db.session.commit()
+
+    # bad input: a bad header, rows COPY can't parse (raised by psycopg2
+    # itself), or rows the upsert rejects
+    except (ValueError, psycopg2.Error, DBAPIError) as exc:
+        db.session.rollback()
+        raise click.ClickException(f"Import failed: {exc}")
+
+    click.echo(f"Added or changed {count} cafe(s).")
+
+
+@cafes_cli.command("export")
+@click.argument("file", type=click.File("w", encoding="UTF-8", lazy=False))
+@click.option(
+    "--format",
+    type=click.Choice(FORMATS),
+    help="File format (default: from its name; CSV unless .ndjson/.jsonl).")
+def export_cafes_command(file, format):
+    """Write every cafe to FILE ("-" for stdout), in the format that
+    `flask cafes import` reads."""
+
+    count = export_cafes(file, format or get_format(file.name))
+
+    click.echo(f"Exported {count} cafe(s).", err=True)
+
+
+@maps_cli.command("regenerate")
+@click.argument("cafe_ids", nargs=-1, type=int)
+@click.option("--workers", type=int, help="Concurrent downloads.")
+@click.option("--rate", type=float, help="Max MapQuest requests per second.")
+@click.option("--force", is_flag=True, help="Refetch maps that are current.")
+def regenerate_maps_command(cafe_ids, workers, rate, force):
+    """Fetch maps for the given cafes (default: all), concurrently."""
+
+    query = Cafe.query.options(db.joinedload(Cafe.city)).order_by(Cafe.id)
+
+    if cafe_ids:
+        query = query.filter(Cafe.id.in_(cafe_ids))
+
+    saved, failed = regenerate_maps(
+        query.all(),
+        workers=workers or current_app.config['MAP_WORKERS'],
+        rate=rate or current_app.config['MAPQUEST_RATE_LIMIT'],
+        force=force,
+    )
+    db.session.commit()
+
+    click.echo(f"Saved {saved} map(s); {failed} failed.")
+
+
+@maps_cli.command("gc")
+@click.option(
+    "--min-age",
+    type=int,
+    default=3600,
+    show_default=True,
+    help="Keep maps changed in the last this-many seconds.")
+def collect_map_garbage_command(min_age):
+    """Delete saved maps that no cafe refers to."""
+
+    count = collect_map_garbage(min_age)
+
+    click.echo(f"Deleted {count} unused map(s).")
+
+
+@images_cli.command("backfill")
+def backfill_thumbnails_command():
+    """Queue thumbnail jobs for cafes and users without current ones."""
+
+    cafe_count, user_count = queue_thumbnails()
+    db.session.commit()
+
+    click.echo(
+        f"Queued thumbnails for {cafe_count} cafe(s) and "
+        f"{user_count} user(s).")
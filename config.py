@@ -0,0 +1,131 @@
+"""Config profiles for Flask Cafe.
+
+Pick one with create_app("production"), or the FLASK_CONFIG environment
+variable; settings can mostly be overridden by environment variables.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL", 'postgresql:///flask_cafe')
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+
+    DEBUG_TB_ENABLED = False
+
+    # database connection pool (per process; see models.get_engine_options)
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+
+    # milliseconds before postgres cancels a statement (0 for no limit)
+    DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", 30000))
+
+    CAFES_PER_PAGE = int(os.environ.get("CAFES_PER_PAGE", 24))
+
+    # `flask maps regenerate`: concurrent downloads, and max requests/second
+    MAP_WORKERS = int(os.environ.get("MAP_WORKERS", 8))
+    MAPQUEST_RATE_LIMIT = float(os.environ.get("MAPQUEST_RATE_LIMIT", 5))
+
+    # seconds browsers may cache map images (their URLs are versioned)
+    MAP_MAX_AGE = int(os.environ.get("MAP_MAX_AGE", 365 * 24 * 60 * 60))
+
+    # cache of rendered cafe cards: in-process LRU of this many cards, or
+    # shared in redis if FRAGMENT_CACHE_URL is set (see cache.py)
+    FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 4096))
+    FRAGMENT_CACHE_URL = os.environ.get("FRAGMENT_CACHE_URL")
+
+    # bcrypt cost of password hashes: each step up doubles the CPU time per
+    # login. Stored hashes of another cost are redone as users log in
+    BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+    # password hashing (see passwords.py): processes per web worker, and
+    # how many more hashes may wait before we answer 503 (0 workers hashes
+    # on the request thread)
+    PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", 2))
+    PASSWORD_QUEUE_DEPTH = int(os.environ.get("PASSWORD_QUEUE_DEPTH", 16))
+
+    # login attempts allowed per minute (and in a burst) from one IP, and
+    # for one username; past that, /login answers 429 without checking the
+    # password. Buckets are shared in redis if RATE_LIMIT_URL is set
+    LOGIN_ATTEMPTS_PER_IP = int(os.environ.get("LOGIN_ATTEMPTS_PER_IP", 20))
+    LOGIN_ATTEMPTS_PER_USERNAME = int(
+        os.environ.get("LOGIN_ATTEMPTS_PER_USERNAME", 5))
+    RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL")
+
+    # number of proxies (e.g. load balancers) in front of the app whose
+    # X-Forwarded-For/-Proto headers are trusted; without this, behind a
+    # proxy every client has the proxy's IP (and shares its login limit)
+    TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+
+    # seconds cities are cached in-process; changes made in this process
+    # clear the cache at once, others show up within this long
+    CITY_CACHE_TTL = int(os.environ.get("CITY_CACHE_TTL", 300))
+
+    # identifies the deployed code; part of every page's ETag, so browsers
+    # don't keep using pages cached before a deploy changed the templates
+    RELEASE = os.environ.get("RELEASE", "")
+
+    # seconds the logged-in user's info is cached in the session
+    SESSION_USER_TTL = int(os.environ.get("SESSION_USER_TTL", 300))
+
+
+class DevelopmentConfig(Config):
+    """Local development: SQL echo and the debug toolbar."""
+
+    SQLALCHEMY_ECHO = True
+
+    DEBUG_TB_ENABLED = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class TestingConfig(Config):
+    """Running tests.py."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "TEST_DATABASE_URL", 'postgresql:///flaskcafe_test')
+
+    # Make Flask errors be real errors, rather than HTML pages with error info
+    TESTING = True
+
+    # Don't req CSRF for testing
+    WTF_CSRF_ENABLED = False
+
+    # hash passwords inline, rather than starting processes, and cheaply
+    PASSWORD_WORKERS = 0
+    BCRYPT_LOG_ROUNDS = 4
+
+    # tests log in many times, all from the same "IP"
+    LOGIN_ATTEMPTS_PER_IP = 1000
+    LOGIN_ATTEMPTS_PER_USERNAME = 1000
+
+
+class ProductionConfig(Config):
+    """Deployed app: no debug-only extensions are even imported."""
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
+
+
+def get_config(config=None):
+    """Return config class for this profile name (or class).
+
+    Defaults to the FLASK_CONFIG environment variable, else "development".
+    """
+
+    if config is None:
+        config = os.environ.get("FLASK_CONFIG", "development")
+
+    if isinstance(config, str):
+        return CONFIGS[config]
+
+    return config
@@ -0,0 +1,26 @@
+"""Gunicorn settings for Flask Cafe.
+
+    gunicorn "app:create_app('production')"
+
+Each worker has its own database pool of DB_POOL_SIZE (+ DB_MAX_OVERFLOW)
+connections, so keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under
+postgres's max_connections.
+
+Each worker also starts up to PASSWORD_WORKERS processes for hashing
+passwords (see passwords.py), so leave CPUs for them.
+"""
+
+import os
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# load the app once in the master, then fork workers from it
+preload_app = True
+
+
+def post_fork(server, worker):
+    """Don't let a worker reuse db connections inherited from the master."""
+
+    from models import dispose_engines
+
+    dispose_engines(worker.app.wsgi())
@@ -0,0 +1,157 @@
+"""Thumbnails of cafe and user images.
+
+Each image is downloaded once and saved as small WebP thumbnails (one per
+size in THUMB_SIZES), named by a hash of the image's URL.
+"""
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from PIL import Image
+
+from mapping import CHUNK_SIZE, HTTP_TIMEOUT, http, write_atomic
+
+APP_DIR = os.path.abspath(os.path.dirname(__file__))
+
+THUMBS_DIR = os.path.join(APP_DIR, "static", "thumbs")
+
+# size -> (max width, max height); thumbnails keep the aspect ratio
+THUMB_SIZES = {
+    "list": (400, 300),
+    "detail": (800, 800),
+}
+
+THUMB_QUALITY = 80
+
+# don't download (or decode) anything bigger than this
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# redirects followed when downloading an image (each target is checked)
+MAX_REDIRECTS = 3
+
+
+def get_image_key(image_url):
+    """Get a hash of this image URL, which its thumbnails are named by."""
+
+    return hashlib.sha1(image_url.encode("UTF-8")).hexdigest()
+
+
+def get_thumb_path(image_key, size):
+    """Return URL path of the thumbnail for this image at this size."""
+
+    return f"/static/thumbs/{image_key}-{size}.webp"
+
+
+def thumbs_exist(image_key):
+    """Return True if every thumbnail of this image has been saved."""
+
+    return all(
+        os.path.isfile(os.path.join(THUMBS_DIR, f"{image_key}-{size}.webp"))
+        for size in THUMB_SIZES)
+
+
+def check_image_url(image_url):
+    """Make sure image_url is http(s) on a public address, so users can't
+    have the worker fetch internal hosts (cloud metadata, databases, ...).
+
+    Raises ValueError if not.
+    """
+
+    parts = urlsplit(image_url)
+
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {image_url}")
+
+    try:
+        addresses = socket.getaddrinfo(
+            parts.hostname, parts.port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError) as exc:
+        raise ValueError(f"Can't resolve {image_url}: {exc}")
+
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0])
+        address = getattr(address, "ipv4_mapped", None) or address
+
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"Not a public address: {image_url}")
+
+
+def read_image(image_url):
+    """Return bytes of image at this URL (or path under /static/).
+
+    Raises ValueError if it's too big, not an allowed path, or not on a
+    public address (see check_image_url).
+    """
+
+    if image_url.startswith("/static/"):
+        path = os.path.normpath(os.path.join(APP_DIR, image_url.lstrip("/")))
+
+        if not path.startswith(os.path.join(APP_DIR, "static") + os.sep):
+            raise ValueError(f"Not a static file: {image_url}")
+
+        if os.path.getsize(path) > MAX_IMAGE_BYTES:
+            raise ValueError(f"Image too big: {image_url}")
+
+        with open(path, "rb") as file:
+            return file.read()
+
+    # follow redirects by hand, so each target gets checked too
+    for _ in range(MAX_REDIRECTS + 1):
+        check_image_url(image_url)
+
+        with http.get(image_url, timeout=HTTP_TIMEOUT, stream=True,
+                      allow_redirects=False) as response:
+            if response.is_redirect:
+                image_url = urljoin(image_url, response.headers["location"])
+                continue
+
+            response.raise_for_status()
+
+            data = io.BytesIO()
+
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                data.write(chunk)
+
+                if data.tell() > MAX_IMAGE_BYTES:
+                    raise ValueError(f"Image too big: {image_url}")
+
+            return data.getvalue()
+
+    raise ValueError(f"Too many redirects: {image_url}")
+
+
+def save_thumbs(image_key, image_url):
+    """Download image and save its thumbnails as "KEY-SIZE.webp".
+
+    Returns True on success, or False if it couldn't be fetched or read.
+    """
+
+    try:
+        image = Image.open(io.BytesIO(read_image(image_url)))
+        image.load()
+
+    except (requests.RequestException, OSError, ValueError,
+            Image.DecompressionBombError) as exc:
+        print(f'Failed to get image {image_url}:', exc)
+        return False
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    os.makedirs(THUMBS_DIR, exist_ok=True)
+
+    for size, dimensions in THUMB_SIZES.items():
+        thumb = image.copy()
+        thumb.thumbnail(dimensions)
+
+        path = os.path.join(THUMBS_DIR, f"{image_key}-{size}.webp")
+
+        write_atomic(path, lambda file: thumb.save(
+            file, "WEBP", quality=THUMB_QUALITY))
+
+    return True
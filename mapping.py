@@ -1,26 +1,144 @@
+import hashlib
 import os
+import tempfile
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
 
+MAPQUEST_URL = os.environ.get(
+    "MAPQUEST_URL", "https://www.mapquestapi.com/staticmap/v5/map")
+
+# max connections kept open to MapQuest; enough for `flask maps regenerate`
+HTTP_POOL_SIZE = int(os.environ.get("MAPQUEST_POOL_SIZE", 16))
+
+# (connect, read) timeouts in seconds
+HTTP_TIMEOUT = (
+    float(os.environ.get("MAPQUEST_CONNECT_TIMEOUT", 3.05)),
+    float(os.environ.get("MAPQUEST_READ_TIMEOUT", 10)),
+)
+
+# retry connection errors and transient server errors, with backoff
+HTTP_RETRIES = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=["GET"],
+)
+
+# download in big chunks, rather than many tiny writes
+CHUNK_SIZE = 64 * 1024
+
+# shared session, so map downloads reuse keep-alive connections
+http = requests.Session()
+http.mount("https://", HTTPAdapter(
+    pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRIES))
+http.mount("http://", HTTPAdapter(
+    pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRIES))
+
+MAPS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                        "static", "maps")
+
+
+# every map is this zoom and size; both are part of the map's key
+MAP_ZOOM = 15
+MAP_SIZE = "@2x"
+
 
 def get_map_url(address, city, state):
     """Get MapQuest URL for a static map for this location."""
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
+    base = f"{MAPQUEST_URL}?key={API_KEY}"
     where = f"{address},{city},{state}"
-    return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
+    return (f"{base}&center={where}&size={MAP_SIZE}&zoom={MAP_ZOOM}"
+            f"&locations={where}")
+
+
+def get_map_key(address, city, state):
+    """Get a hash of the normalized location (plus zoom and size) a map is
+    built from. Maps are stored under this key, so cafes at the same
+    location share one map file.
+
+    Two locations that only differ in case or whitespace get the same key.
+    """
 
+    parts = [" ".join(part.lower().split()) for part in (address, city, state)]
+    parts += [str(MAP_ZOOM), MAP_SIZE]
 
-def save_map(id, address, city, state):
-    """Get static map and save in static/maps directory of this app."""
+    return hashlib.sha1("|".join(parts).encode("UTF-8")).hexdigest()
+
+
+def get_map_path(map_key):
+    """Return URL path of the map with this key.
+
+    Maps are served by the /maps route (not /static), which lets browsers
+    cache them forever: the URL ends in ?v= and a hash of the map's
+    content, so it changes whenever the map is refetched.
+    """
+
+    version = get_map_version(map_key)
+
+    if version is None:
+        return f"/maps/{map_key}.jpg"
+
+    return f"/maps/{map_key}.jpg?v={version}"
+
+
+# map key -> (inode, mtime, size, content hash) of its file, so each map
+# is only hashed again once it's replaced
+_map_versions = {}
+
+
+def get_map_version(map_key):
+    """Return a short hash of the saved map's content, or None if it hasn't
+    been saved."""
+
+    path = os.path.join(MAPS_DIR, f"{map_key}.jpg")
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
 
-    # FIXME: get URL for map, download it, and save it with a path -> DONE
-    #   like "PATH/static/maps/1.jpg"
+    cached = _map_versions.get(map_key)
 
-    # path = os.path.abspath(os.path.dirname(__file__))
+    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
-    path = os.path.abspath(os.path.dirname(__file__))
+    if cached and cached[:3] == stamp:
+        return cached[3]
+
+    with open(path, "rb") as file:
+        version = hashlib.sha1(file.read()).hexdigest()[:16]
+
+    _map_versions[map_key] = (*stamp, version)
+
+    return version
+
+
+def map_exists(map_key):
+    """Return True if the map with this key has already been saved."""
+
+    return os.path.isfile(os.path.join(MAPS_DIR, f"{map_key}.jpg"))
+
+
+def list_maps():
+    """Return (key, file path) for every saved map."""
+
+    return [
+        (name.removesuffix(".jpg"), os.path.join(MAPS_DIR, name))
+        for name in os.listdir(MAPS_DIR)
+        if name.endswith(".jpg")
+    ]
+
+
+def save_map(map_key, address, city, state):
+    """Get static map and save in static/maps directory of this app, as
+    "KEY.jpg" (see get_map_key).
+
+    Returns the map's URL path, or None if it couldn't be fetched.
+    """
 
     url_address = '+'.join(address.split())
     url_city = '+'.join(city.split())
@@ -28,25 +146,55 @@ def save_map(id, address, city, state):
 
     url = get_map_url(url_address, url_city, url_state)
 
-    response = requests.get(url)
-
-    map_url = f"{path}/static/maps/{id}.jpg"
+    map_path = os.path.join(MAPS_DIR, f"{map_key}.jpg")
 
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        # Save the processed data to a file
-        with open(map_url, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=128):
-                file.write(chunk)
-        print('Data saved successfully.')
+    try:
+        with http.get(url, timeout=HTTP_TIMEOUT, stream=True) as response:
+            if response.status_code != 200:
+                print(
+                    f'Failed to fetch map {map_key}. Status code:',
+                    response.status_code)
+                return None
 
-        return f"/static/maps/{id}.jpg"
+            download_to(response, map_path)
 
-    else:
-        print(
-            f'Failed to fetch image from {map_url}. Status code:', response.status_code)
+    except (requests.RequestException, OSError) as exc:
+        print(f'Failed to fetch map {map_key}:', exc)
         return None
 
+    return get_map_path(map_key)
+
+
+def download_to(response, path):
+    """Save body of (streamed) response to path (see write_atomic)."""
+
+    def write(file):
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            file.write(chunk)
+
+    write_atomic(path, write)
+
+
+def write_atomic(path, write):
+    """Save a file at path, calling write(file) to fill it in.
+
+    Writes to a temp file and renames it into place, so readers never see
+    a half-written file.
+    """
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
 
 # Example usage:
 # save_map(1, "205 E 95th St.", "New York", "NY")
@@ -0,0 +1,66 @@
+"""In-process metrics for Flask Cafe.
+
+Counters and timings are kept per process (so per gunicorn worker), and
+served as JSON by the /metrics endpoint.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Metrics:
+    """Thread-safe registry of counters and timings."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, amount=1):
+        """Add amount to counter name."""
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """Record one timing (in seconds) for name."""
+
+        with self._lock:
+            timing = self.timings.setdefault(
+                name, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the block and record it for name."""
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return a copy of every metric, with mean timings added."""
+
+        with self._lock:
+            timings = {
+                name: {**timing, "mean": timing["total"] / timing["count"]}
+                for name, timing in self.timings.items()
+            }
+
+            return {"counters": dict(self.counters), "timings": timings}
+
+    def reset(self):
+        """Forget every metric."""
+
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+metrics = Metrics()
@@ -1,15 +1,67 @@
 """Data models for Flask Cafe"""
 
-from flask_bcrypt import Bcrypt
+from collections import namedtuple
+from datetime import datetime
+import time
+
 from flask_sqlalchemy import SQLAlchemy
-from mapping import save_map
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from images import get_image_key, get_thumb_path, save_thumbs, thumbs_exist
+from mapping import get_map_key, get_map_path, map_exists, save_map
+from metrics import metrics
+from passwords import get_hasher, PoolSaturated
 
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 DEFAULT_USER_IMAGE_URL = ("/static/images/default-pic.png")
 
+#######################################
+# Image thumbnails
+
+
+class ImageMixin:
+    """Local thumbnails of a model's image_url (see images.py)."""
+
+    # key of the saved thumbnails of image_url; see make_thumbnails
+    image_key = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    def get_image(self, size):
+        """Return URL of image at this size ("list" or "detail").
+
+        That's a local thumbnail once one has been made for the current
+        image_url, else the original image.
+        """
+
+        if self.image_key and self.image_key == get_image_key(self.image_url):
+            return get_thumb_path(self.image_key, size)
+
+        return self.image_url
+
+    def make_thumbnails(self):
+        """Make thumbnails of image_url, unless they've been made already,
+        and update image_key to point to them.
+
+        Returns True on success.
+        """
+
+        image_key = get_image_key(self.image_url)
+
+        if not thumbs_exist(image_key):
+            if not save_thumbs(image_key, self.image_url):
+                return False
+
+        self.image_key = image_key
+
+        return True
+
+
 #######################################
 # City model
 
@@ -34,11 +86,114 @@ class City(db.Model):
         nullable=False,
     )
 
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+
+# a city, as kept in the city cache (not tied to any session)
+CityInfo = namedtuple("CityInfo", ["code", "name", "state", "updated_at"])
+
+
+class CityCache:
+    """In-process cache of every city, as CityInfo by code (in name order).
+
+    Cities hardly ever change, so they're loaded once and kept until a
+    city is added, changed or deleted in this process (see the session
+    listeners below), or for at most ttl seconds, so changes made by other
+    processes show up eventually.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._cities = None
+        self._loaded_at = 0
+        # bumped by clear, so a load that raced a change isn't kept
+        self._generation = 0
+
+    def get_all(self):
+        """Return dict of every city, as {code: CityInfo}."""
+
+        cities = self._cities
+
+        if cities is None or self._loaded_at + self.ttl < time.monotonic():
+            generation = self._generation
+
+            rows = db.session.execute(
+                db.select(City.code, City.name, City.state, City.updated_at)
+                .order_by(City.name))
+            cities = {row.code: CityInfo(*row) for row in rows}
+
+            if generation == self._generation:
+                self._cities = cities
+                self._loaded_at = time.monotonic()
+
+        return cities
+
+    def get(self, code):
+        """Return CityInfo for city with this code, or None."""
+
+        city = self.get_all().get(code)
+
+        # may be a city another process added since we loaded
+        if city is None and self._cities is not None:
+            self.clear()
+            city = self.get_all().get(code)
+
+        return city
+
+    def clear(self):
+        """Forget every city; they're reloaded when next needed."""
+
+        self._generation += 1
+        self._cities = None
+
+
+city_cache = CityCache()
+
+
+@db.event.listens_for(Session, "after_flush")
+def note_city_changes(session, flush_context):
+    """Clear city cache if this flush changed any city.
+
+    It's cleared again when the transaction ends, in case the cache was
+    reloaded (by another request, with the old cities, or by this one,
+    with changes that may be rolled back) in the meantime.
+    """
+
+    if any(isinstance(obj, City)
+           for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["cities_changed"] = True
+        city_cache.clear()
+
+
+@db.event.listens_for(Session, "do_orm_execute")
+def note_city_statements(orm_execute_state):
+    """Clear city cache on bulk UPDATE or DELETE of cities."""
+
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete)
+            and any(mapper.class_ is City
+                    for mapper in orm_execute_state.all_mappers)):
+        orm_execute_state.session.info["cities_changed"] = True
+        city_cache.clear()
+
+
+@db.event.listens_for(Session, "after_commit")
+@db.event.listens_for(Session, "after_rollback")
+def clear_changed_cities(session):
+    """Clear city cache as a transaction that changed cities ends."""
+
+    if session.info.pop("cities_changed", False):
+        city_cache.clear()
+
 #######################################
 # Cafe model
 
 
-class Cafe(db.Model):
+class Cafe(ImageMixin, db.Model):
     """Cafe information."""
 
     __tablename__ = 'cafes'
@@ -80,43 +235,273 @@ class Cafe(db.Model):
         default="/static/images/default-cafe.jpg",
     )
 
+    # key of this cafe's saved map (a hash of its location; cafes at the
+    # same location share a map); see get_cafe_map
+    map_key = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    # denormalized count of likes; kept up to date by Like.add/Like.remove
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # bumped whenever the cafe changes; keys cached renderings of it
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
     city = db.relationship("City", backref='cafes')
 
+    # cafes are listed (and paginated) by (name, id) or (like_count, id),
+    # optionally by city; (name, address, city_code) identifies a cafe in
+    # bulk imports (see bulk.py)
+    __table_args__ = (
+        db.UniqueConstraint(
+            'name', 'address', 'city_code',
+            name='uq_cafes_name_address_city_code'),
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+        db.Index('ix_cafes_city_code_name_id', 'city_code', 'name', 'id'),
+        db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+    )
+
+    # ways to sort pages of cafes: sort -> (key column, descending?)
+    # (every sort is tie-broken by id)
+    SORTS = {
+        "name": ("name", False),
+        "likes": ("like_count", True),
+    }
+
+    # fields of cafes in the API (see to_dict)
+    API_FIELDS = (
+        "name", "description", "url", "address", "city_code", "city",
+        "state", "image_url", "map_url", "like_count",
+    )
+
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    @classmethod
+    def get_page(
+            cls,
+            per_page,
+            after=None,
+            before=None,
+            city_code=None,
+            sort="name"):
+        """Get a page of cafes.
+
+        Uses keyset pagination: after/before are the (sort key, id) of the
+        cafe just before/after the wanted page, so each page is an index
+        seek rather than an OFFSET scan.
+
+        Returns (cafes, has_prev, has_next).
+        """
+
+        column, descending = cls.SORTS[sort]
+        columns = (getattr(cls, column), cls.id)
+        key = db.tuple_(*columns)
+
+        if descending:
+            forward = [c.desc() for c in columns]
+            backward = [c.asc() for c in columns]
+            is_after, is_before = key.__lt__, key.__gt__
+        else:
+            forward = [c.asc() for c in columns]
+            backward = [c.desc() for c in columns]
+            is_after, is_before = key.__gt__, key.__lt__
+
+        query = cls.query
+
+        if city_code:
+            query = query.filter(cls.city_code == city_code)
+
+        if before:
+            cafes = (query
+                     .filter(is_before(db.tuple_(*before)))
+                     .order_by(*backward)
+                     .limit(per_page + 1)
+                     .all())
+
+            has_prev = len(cafes) > per_page
+
+            return cafes[:per_page][::-1], has_prev, True
+
+        if after:
+            query = query.filter(is_after(db.tuple_(*after)))
+
+        cafes = query.order_by(*forward).limit(per_page + 1).all()
+
+        has_next = len(cafes) > per_page
+
+        return cafes[:per_page], after is not None, has_next
+
+    @classmethod
+    def stream(cls, city_code=None, batch_size=1000):
+        """Yield every cafe (optionally, only those in this city) by id.
+
+        Rows are fetched batch_size at a time from a server-side cursor,
+        so memory use doesn't grow with the number of cafes.
+        """
+
+        query = db.select(cls).order_by(cls.id)
+
+        if city_code:
+            query = query.where(cls.city_code == city_code)
+
+        yield from db.session.scalars(
+            query.execution_options(yield_per=batch_size))
+
+    def get_cursor(self, sort="name"):
+        """Return page cursor ("ID:SORT-KEY") pointing at this cafe."""
+
+        column, _ = self.SORTS[sort]
+
+        return f"{self.id}:{getattr(self, column)}"
+
+    @classmethod
+    def parse_cursor(cls, cursor, sort="name"):
+        """Parse a page cursor into a (sort key, id) tuple, or None."""
+
+        if not cursor:
+            return None
+
+        id, _, value = cursor.partition(":")
+
+        try:
+            if sort == "likes":
+                value = int(value)
+
+            return (value, int(id))
+
+        except ValueError:
+            return None
+
+    @classmethod
+    def recount_likes(cls):
+        """Recompute like_count for every cafe whose count is off.
+
+        Returns number of cafes fixed.
+        """
+
+        count = (db.select(db.func.count())
+                 .where(Like.cafe_id == cls.id)
+                 .scalar_subquery())
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(cls.like_count != count)
+            .values(like_count=count, version=cls.version + 1,
+                    updated_at=datetime.utcnow())
+        )
+
+        return result.rowcount
+
+    def get_city(self):
+        """Return CityInfo for cafe's city (from the city cache)."""
+
+        return city_cache.get(self.city_code)
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = self.get_city()
         return f'{city.name}, {city.state}'
 
     def get_state(self):
         """Return 'state' for cafe."""
 
-        city = self.city
+        city = self.get_city()
         return f'{city.state}'
 
+    def get_map_key(self):
+        """Return hash of this cafe's current location."""
+
+        # look up by code (not self.city) so an edited city_code is honored
+        city = self.get_city()
+
+        return get_map_key(self.address, city.name, city.state)
+
+    def get_cached_map(self):
+        """Returns map path for cafe if an up-to-date map has been saved,
+        else None. Never fetches a map.
+        """
+
+        if self.map_key == self.get_map_key() and map_exists(self.map_key):
+            return get_map_path(self.map_key)
+
+        return None
+
     def get_cafe_map(self):
-        """Returns map path for cafe"""
+        """Returns map path for cafe, or None if it couldn't be fetched.
 
-        path = save_map(self.id, self.address, self.city.name, self.city.state)
+        A map is only fetched if there isn't one saved for this location
+        already (from this cafe or another at the same location). Updates
+        map_key to point to it.
+        """
 
-        return path
+        map_key = self.get_map_key()
 
-    def to_dict(self):
-        """Serialize user to a dict of user info."""
+        if not map_exists(map_key):
+            city = self.get_city()
 
-        return {
-            "id": self.id,
-            "name": self.name
+            if not save_map(map_key, self.address, city.name, city.state):
+                return None
+
+        self.map_key = map_key
+
+        return get_map_path(map_key)
+
+    def to_dict(self, fields=None):
+        """Serialize cafe to a dict of cafe info.
+
+        Includes id plus these fields (from API_FIELDS), or all of them if
+        fields is None.
+        """
+
+        values = {
+            "name": lambda: self.name,
+            "description": lambda: self.description,
+            "url": lambda: self.url,
+            "address": lambda: self.address,
+            "city_code": lambda: self.city_code,
+            "city": lambda: self.get_city().name,
+            "state": lambda: self.get_city().state,
+            "image_url": lambda: self.get_image("detail"),
+            "map_url": self.get_cached_map,
+            "like_count": lambda: self.like_count,
         }
 
+        if fields is None:
+            fields = self.API_FIELDS
+
+        return {"id": self.id, **{field: values[field]() for field in fields}}
+
+
+@db.event.listens_for(Cafe, "before_update")
+def bump_cafe_version(mapper, connection, cafe):
+    """Bump version of a changed cafe as it's saved."""
+
+    if db.session.is_modified(cafe, include_collections=False):
+        cafe.version = Cafe.version + 1
+
 
 #######################################
 # User model
 
-class User(db.Model):
+class User(ImageMixin, db.Model):
     """User information."""
 
     __tablename__ = 'users'
@@ -210,10 +595,11 @@ class User(db.Model):
         """Sign up user.
 
         Hashes password and adds user to session.
+
+        Raises PoolSaturated if too many passwords are being hashed.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(
-            password).decode('UTF-8')
+        hashed_pwd = get_hasher().hash(password)
 
         user = User(
             username=username,
@@ -235,31 +621,97 @@ class User(db.Model):
         """Searches for a user whose hashed password matches this password.
         If found, returns the user instance.
 
+        If the user's hash was made with a different cost than the current
+        BCRYPT_LOG_ROUNDS, it's rehashed (caller should commit).
+
         If it can't find matching user (or if password is wrong), returns
         False.
+
+        Raises PoolSaturated if too many passwords are being hashed.
         """
 
         user = cls.query.filter_by(username=username).one_or_none()
+        hasher = get_hasher()
 
         if user:
-            is_auth = bcrypt.check_password_hash(
-                user.hashed_password, password)
+            is_auth = hasher.check(user.hashed_password, password)
             if is_auth:
+                if hasher.needs_rehash(user.hashed_password):
+                    # not worth failing the login over; try again next time
+                    try:
+                        user.hashed_password = hasher.hash(password)
+                    except PoolSaturated:
+                        pass
+
                 return user
 
         return False
 
 
+class TimedQueuePool(QueuePool):
+    """Connection pool that records how long checkouts wait (metric
+    "db.pool.checkout_wait") and how often they time out
+    ("db.pool.timeouts"), so the pool can be sized from data."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            metrics.incr("db.pool.timeouts")
+            raise
+        finally:
+            metrics.observe(
+                "db.pool.checkout_wait", time.perf_counter() - start)
+
+
+def get_engine_options(config):
+    """Return SQLAlchemy engine options from the app's DB_POOL_* and
+    DB_STATEMENT_TIMEOUT settings."""
+
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+    if config["DB_STATEMENT_TIMEOUT"]:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"
+        }
+
+    return options
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
     You should call this in your Flask app.
     """
 
-    app.app_context().push()
-    db.app = app
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **get_engine_options(app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
+
     db.init_app(app)
 
+
+def dispose_engines(app):
+    """Drop the pooled connections of app's engines, without closing them.
+
+    Call in a freshly forked process (e.g. gunicorn's post_fork), so it
+    never shares the parent's connections.
+    """
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
 #######################################
 # Likes model
 
@@ -282,3 +734,196 @@ class Like(db.Model):
         nullable=False,
         primary_key=True
     )
+
+    # the primary key only helps lookups by user; this one is for by-cafe
+    # lookups like recounting likes
+    __table_args__ = (
+        db.Index('ix_likes_cafe_id', 'cafe_id'),
+    )
+
+    @classmethod
+    def is_liked(cls, user_id, cafe_id):
+        """Return True if this user likes this cafe.
+
+        Checks the (user_id, cafe_id) primary key directly, rather than
+        loading all of the user's liked cafes.
+        """
+
+        return db.session.scalar(db.select(db.exists().where(
+            cls.user_id == user_id,
+            cls.cafe_id == cafe_id,
+        )))
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """Make this user like this cafe, if they don't already.
+
+        A single INSERT ... ON CONFLICT DO NOTHING (which also bumps the
+        cafe's like_count if a like was added), so liking twice is
+        harmless. Returns True if a like was added.
+
+        Raises IntegrityError if there is no such user or cafe.
+        """
+
+        added = (insert(cls)
+                 .values(user_id=user_id, cafe_id=cafe_id)
+                 .on_conflict_do_nothing()
+                 .returning(cls.cafe_id)
+                 .cte("added"))
+
+        result = db.session.execute(
+            db.update(Cafe)
+            .where(Cafe.id.in_(db.select(added.c.cafe_id)))
+            .values(like_count=Cafe.like_count + 1, version=Cafe.version + 1,
+                    updated_at=datetime.utcnow())
+        )
+
+        return result.rowcount == 1
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """Make this user stop liking this cafe, if they do.
+
+        A single DELETE (which also lowers the cafe's like_count if a like
+        was removed). Returns True if a like was removed.
+        """
+
+        removed = (db.delete(cls)
+                   .where(cls.user_id == user_id, cls.cafe_id == cafe_id)
+                   .returning(cls.cafe_id)
+                   .cte("removed"))
+
+        result = db.session.execute(
+            db.update(Cafe)
+            .where(Cafe.id.in_(db.select(removed.c.cafe_id)))
+            .values(like_count=Cafe.like_count - 1, version=Cafe.version + 1,
+                    updated_at=datetime.utcnow())
+        )
+
+        return result.rowcount == 1
+
+    @classmethod
+    def toggle(cls, user_id, cafe_id):
+        """Flip whether this user likes this cafe. Returns the new state.
+
+        Caller should commit, so the flip happens in one transaction.
+        """
+
+        if cls.remove(user_id, cafe_id):
+            return False
+
+        cls.add(user_id, cafe_id)
+
+        return True
+
+    @classmethod
+    def count_for(cls, cafe_id):
+        """Return number of users who like this cafe (its like_count)."""
+
+        return db.session.scalar(
+            db.select(Cafe.like_count).where(Cafe.id == cafe_id))
+
+#######################################
+# Job model
+
+
+class Job(db.Model):
+    """Background job (e.g. rendering a cafe map), run by the worker."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    target_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="pending",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_jobs_pending_run_at',
+            'run_at',
+            postgresql_where=db.text("status = 'pending'"),
+        ),
+    )
+
+    def __repr__(self):
+        return f'<Job #{self.id}: {self.kind} {self.target_id} {self.status}>'
+
+    @classmethod
+    def enqueue(cls, kind, target_id, retry_failed=True):
+        """Add a pending job to session, unless the same one is pending (or,
+        unless retry_failed, has already failed for good).
+
+        Returns the (new or existing) job.
+        """
+
+        statuses = ["pending"] if retry_failed else ["pending", "failed"]
+
+        job = cls.query.filter(
+            cls.kind == kind,
+            cls.target_id == target_id,
+            cls.status.in_(statuses),
+        ).first()
+
+        if not job:
+            job = Job(kind=kind, target_id=target_id)
+            db.session.add(job)
+
+        return job
+
+    @classmethod
+    def enqueue_many(cls, kind, target_ids):
+        """Add pending jobs of this kind for these targets (skipping any
+        already pending), in one INSERT. Returns number of jobs added."""
+
+        if not target_ids:
+            return 0
+
+        targets = db.select(
+            db.func.unnest(db.literal(list(target_ids), ARRAY(db.Integer)))
+            .label("target_id")).subquery()
+
+        pending = db.select(cls.id).where(
+            cls.kind == kind,
+            cls.target_id == targets.c.target_id,
+            cls.status == "pending")
+
+        result = db.session.execute(
+            insert(cls).from_select(
+                ["kind", "target_id"],
+                db.select(db.literal(kind), targets.c.target_id)
+                .where(~db.exists(pending))))
+
+        return result.rowcount
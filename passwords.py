@@ -0,0 +1,133 @@
+"""Password hashing for Flask Cafe.
+
+bcrypt is slow on purpose (100-300 ms of CPU per hash), so hashes are
+computed in a small pool of worker processes rather than on the request
+thread, where a burst of logins would stall every other request in that
+gunicorn worker.
+
+At most PASSWORD_WORKERS hashes run at once, and at most
+PASSWORD_QUEUE_DEPTH more wait for a turn; past that, hashing fails fast
+with PoolSaturated (which the app turns into a 503). With
+PASSWORD_WORKERS = 0, hashes are computed inline (as in tests).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import threading
+
+import bcrypt
+from flask import current_app
+
+from metrics import metrics
+
+# default bcrypt cost of new hashes (see BCRYPT_LOG_ROUNDS setting)
+LOG_ROUNDS = 12
+
+# seconds clients are told to wait when the pool is saturated
+RETRY_AFTER = 1
+
+
+class PoolSaturated(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+def _hash(password, rounds):
+    """Return bcrypt hash of password (in a worker process)."""
+
+    return bcrypt.hashpw(
+        password.encode("UTF-8"), bcrypt.gensalt(rounds)).decode("UTF-8")
+
+
+def _check(hashed, password):
+    """Return True if password matches hash (in a worker process)."""
+
+    return bcrypt.checkpw(password.encode("UTF-8"), hashed.encode("UTF-8"))
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded pool of processes.
+
+    The pool is started on first use (so in each gunicorn worker, after
+    it forks, rather than in the master).
+    """
+
+    def __init__(self, workers=2, queue_depth=16, rounds=LOG_ROUNDS):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.rounds = rounds
+
+        # a slot for each hash running or waiting
+        self._slots = threading.BoundedSemaphore(
+            workers + queue_depth) if workers + queue_depth else None
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def shutdown(self):
+        """Stop the pool's processes, if started."""
+
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+        self._pool = None
+
+    def _get_pool(self):
+        """Return the process pool, starting it if need be."""
+
+        with self._lock:
+            # a pool inherited from a parent process isn't ours to use
+            if self._pool is None or self._pid != os.getpid():
+                # spawn, since forking a threaded web worker isn't safe
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+                self._pid = os.getpid()
+
+            return self._pool
+
+    def _run(self, func, *args):
+        """Run func(*args) in the pool (or inline), and return its result.
+
+        Raises PoolSaturated if every slot is taken.
+        """
+
+        slots = self._slots
+
+        if slots is None or not slots.acquire(blocking=False):
+            metrics.incr("passwords.saturated")
+            raise PoolSaturated()
+
+        try:
+            with metrics.timer("passwords.hash"):
+                if not self.workers:
+                    return func(*args)
+
+                return self._get_pool().submit(func, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """Return bcrypt hash of password, as a string."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Return True if password matches this bcrypt hash."""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Return True if this hash's cost isn't the current one.
+
+        (Hashes look like "$2b$12$...", where 12 is the cost.)
+        """
+
+        return int(hashed.split("$")[2]) != self.rounds
+
+
+def get_hasher():
+    """Return the current app's PasswordHasher (see create_app)."""
+
+    return current_app.extensions['password_hasher']
@@ -0,0 +1,149 @@
+"""Rate limiting for Flask Cafe.
+
+TokenBucket limits one thing (like our MapQuest requests); RateLimiter
+keeps a bucket per key (like per client IP). Set RATE_LIMIT_URL to a
+redis:// URL to share those buckets between processes (needs the redis
+package).
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket allowing rate events per second on average, in bursts
+    of up to capacity. Thread-safe."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token if there is one.
+
+        Returns 0 if a token was taken, else seconds until one is available.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+    def wait(self):
+        """Block until a token can be taken, then take it."""
+
+        while (delay := self.take()):
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """A token bucket per key (like a client's IP), kept in-process.
+
+    Holds buckets for up to maxsize keys, dropping the least recently used
+    (which then start over full). Thread-safe.
+    """
+
+    def __init__(self, rate, capacity=None, maxsize=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token from key's bucket if there is one.
+
+        Returns 0 if a token was taken, else seconds until one is available.
+        """
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    self.rate, self.capacity)
+
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+
+        return bucket.take()
+
+
+class RedisRateLimiter:
+    """A token bucket per key, shared between processes in redis.
+
+    Each bucket is updated by one Lua script, so concurrent takes can't
+    race, and expires once it would be full again.
+    """
+
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + (now - updated) * rate)
+
+        local delay = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            delay = (1 - tokens) / rate
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+
+        return tostring(delay)
+    """
+
+    def __init__(self, url, prefix, rate, capacity=None):
+        # optional dependency; only needed if this backend is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+        self.prefix = prefix
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+
+    def take(self, key):
+        """Take a token from key's bucket if there is one.
+
+        Returns 0 if a token was taken, else seconds until one is available.
+        """
+
+        delay = self.script(
+            keys=[f"{self.prefix}:{key}"], args=[self.rate, self.capacity])
+
+        return float(delay)
+
+
+def make_rate_limiter(config, prefix, per_minute):
+    """Return limiter allowing per_minute takes per key each minute (in a
+    burst, at most), shared in redis if RATE_LIMIT_URL is set."""
+
+    rate = per_minute / 60
+
+    if config['RATE_LIMIT_URL']:
+        return RedisRateLimiter(
+            config['RATE_LIMIT_URL'], prefix, rate, per_minute)
+
+    return RateLimiter(rate, per_minute)
@@ -2,7 +2,11 @@
 
 from models import City, Cafe, db, User
 
-from app import app
+from app import create_app
+from worker import regenerate_maps
+
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -85,11 +89,17 @@ ua.liked_cafes.append(c1)
 
 db.session.commit()
 
+Cafe.recount_likes()
+db.session.commit()
+
 
 #######################################
 # cafe maps
 
-c1.save_map()
-c2.save_map()
+regenerate_maps(
+    [c1, c2],
+    workers=app.config['MAP_WORKERS'],
+    rate=app.config['MAPQUEST_RATE_LIMIT'],
+)
 
 db.session.commit()
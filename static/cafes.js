@@ -1,65 +1,25 @@
 "use strict";
 
 const $likeButton = $("#like-btn");
+const $likeCount = $("#like-count");
 
 /* Handles cafe like */
 async function handleLikeBtnClick(evt) {
   let $cafeId = $(evt.target).parent();
   let cafeId = parseInt($cafeId.attr('cafe-data-id'));
-  let userId = $cafeId.attr('logged-user');
-  let btnStatus;
 
-  let is_cafe_liked = await isLiked(userId, cafeId);
-
-  if (is_cafe_liked.likes === false) {
-    btnStatus = await likeCafe(userId, cafeId);
-  } else {
-    btnStatus = await unlikeCafe(userId, cafeId);
-  }
+  let btnStatus = await toggleLike(cafeId);
 
   toogleLikeBtn(btnStatus);
+  $likeCount.text(btnStatus.likeCount);
 }
 
-/* Figures out if the current user likes a cafe */
-async function isLiked(userId, cafeId) {
-  const params = new URLSearchParams(
-    {
-      cafeId: cafeId,
-      userId: userId
-    }
-  );
-
-  const response = await fetch(`/api/likes?${params}`);
-  const data = await response.json();
-
-  return data;
-}
-
-/* Likes a cafe  */
-async function likeCafe(userId, cafeId) {
-  const response = await fetch(`/api/like`, {
-    method: "POST",
-    body: JSON.stringify({
-      userId: userId,
-      cafeId: cafeId
-    }),
-    headers: {
-      "Content-Type": "application/json"
-    }
-  });
-
-  const data = await response.json();
-
-  return data;
-}
-
-/* Unlikes a cafe  */
-async function unlikeCafe(userId, cafeId) {
-
-  const response = await fetch(`/api/unlike`, {
+/* Likes a cafe if the logged-in user doesn't, else unlikes it.
+ * Returns e.g. {likes: true, likeCount: 3} */
+async function toggleLike(cafeId) {
+  const response = await fetch(`/api/likes/toggle`, {
     method: "POST",
     body: JSON.stringify({
-      userId: userId,
       cafeId: cafeId
     }),
     headers: {
@@ -73,12 +33,12 @@ async function unlikeCafe(userId, cafeId) {
 }
 
 /* Toogles button between liked and unliked */
-function toogleLikeBtn(liked) {
-  if (liked['unliked'] === undefined) {
+function toogleLikeBtn(status) {
+  if (status.likes === true) {
     $likeButton.text("Liked");
   } else {
     $likeButton.text("Like");
   }
 }
 
-$likeButton.on("click", handleLikeBtnClick);
\ No newline at end of file
+$likeButton.on("click", handleLikeBtnClick);
@@ -1,22 +1,40 @@
 """Tests for Flask Cafe."""
 
 
-from flask import session, g
+from flask import session, g, template_rendered
 import re
-from models import db, Cafe, City, connect_db, User, Like
-from app import app, CURR_USER_KEY, add_user_to_g
+from models import (
+    db, Cafe, City, connect_db, User, Like, Job, city_cache,
+    DEFAULT_USER_IMAGE_URL)
+from images import THUMB_SIZES, get_image_key, read_image
+from PIL import Image
+from app import create_app, CURR_USER_KEY, add_user_to_g
+from config import TestingConfig
+from worker import (
+    run_pending_jobs, regenerate_maps, collect_map_garbage, MAX_ATTEMPTS)
+from ratelimit import RateLimiter, TokenBucket
+from cache import LRUCache
+from metrics import metrics
+from passwords import PasswordHasher, PoolSaturated
+from contextlib import contextmanager
+from datetime import datetime
 from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+import hashlib
+import json
+import mapping
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
-os.environ["FLASK_DEBUG"] = "0"
-
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+# testing profile uses TEST_DATABASE_URL (default postgresql:///flaskcafe_test)
+# and turns off CSRF
+app = create_app("testing")
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -41,6 +59,27 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+@contextmanager
+def count_queries():
+    """Count SQL statements run inside this block.
+
+    Yields a list that ends up holding the statements.
+    """
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    db.event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    try:
+        yield statements
+    finally:
+        db.event.remove(
+            db.engine, "before_cursor_execute", before_cursor_execute)
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -107,6 +146,47 @@ ADMIN_USER_DATA = dict(
 )
 
 
+#######################################
+# app
+
+class AppFactoryTestCase(TestCase):
+    """Tests for create_app and its config profiles."""
+
+    def test_profiles(self):
+        self.assertTrue(app.testing)
+        self.assertFalse(create_app("production").testing)
+
+    def test_production_skips_debug_toolbar(self):
+        code = ("import sys, app; app.create_app('production'); "
+                "print('flask_debugtoolbar' in sys.modules)")
+
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        self.assertEqual(out.stdout.strip(), "False")
+
+    def test_pool_config(self):
+        pool = db.engine.pool
+        self.assertEqual(pool.size(), app.config['DB_POOL_SIZE'])
+
+        timeout = db.session.scalar(db.text("SHOW statement_timeout"))
+        self.assertEqual(timeout, "30s")
+
+    def test_metrics(self):
+        db.session.commit()
+        db.session.scalar(db.text("SELECT 1"))
+
+        with app.test_client() as client:
+            resp = client.get("/metrics")
+
+        self.assertGreater(
+            resp.json["timings"]["db.pool.checkout_wait"]["count"], 0)
+
+
 #######################################
 # homepage
 
@@ -119,6 +199,162 @@ class HomepageViewsTestCase(TestCase):
             resp = client.get("/")
             self.assertIn(b'Where Coffee Dreams Come True', resp.data)
 
+    def test_no_user_load(self):
+        with app.test_client() as client:
+            # logged in, but without user info cached in the session
+            login_for_test(client, 1)
+
+            with count_queries() as statements:
+                resp = client.get("/")
+                self.assertEqual(resp.status_code, 200)
+
+                resp = client.get("/health")
+                self.assertEqual(resp.json, {"status": "ok"})
+
+                resp = client.get("/static/style/style.css")
+                self.assertEqual(resp.status_code, 200)
+                resp.close()
+
+                resp = client.get("/no-such-page")
+                self.assertEqual(resp.status_code, 404)
+
+            self.assertEqual(statements, [])
+
+
+#######################################
+# maps
+
+MAP_BYTES = b"\xff\xd8not-really-a-jpeg" * 10000
+
+
+class StubMapHandler(BaseHTTPRequestHandler):
+    """Stands in for MapQuest: serves MAP_BYTES, or a 404 for bad keys."""
+
+    def do_GET(self):
+        if "key=bad" in self.path:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(MAP_BYTES)))
+        self.end_headers()
+        self.wfile.write(MAP_BYTES)
+
+    def log_message(self, *args):
+        pass
+
+
+def use_temp_maps_dir(test):
+    """Save maps in a temp dir for the rest of this test."""
+
+    maps_dir = tempfile.TemporaryDirectory()
+    test.addCleanup(maps_dir.cleanup)
+
+    maps_dir_patch = patch("mapping.MAPS_DIR", maps_dir.name)
+    maps_dir_patch.start()
+    test.addCleanup(maps_dir_patch.stop)
+
+
+def fake_save_map(map_key, address, city, state):
+    """Stands in for mapping.save_map: saves an empty map, no network."""
+
+    open(os.path.join(mapping.MAPS_DIR, f"{map_key}.jpg"), "wb").close()
+
+    return mapping.get_map_path(map_key)
+
+
+class SaveMapTestCase(TestCase):
+    """Tests for downloading maps (from a local stub server)."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubMapHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.maps_dir = tempfile.TemporaryDirectory()
+
+        url = f"http://127.0.0.1:{self.server.server_port}/staticmap"
+        self.patches = [
+            patch("mapping.MAPQUEST_URL", url),
+            patch("mapping.MAPS_DIR", self.maps_dir.name),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.maps_dir.cleanup()
+
+    def test_save_map(self):
+        path = mapping.save_map(7, "500 Sansome St", "San Francisco", "CA")
+
+        version = hashlib.sha1(MAP_BYTES).hexdigest()[:16]
+        self.assertEqual(path, f"/maps/7.jpg?v={version}")
+        self.assertEqual(os.listdir(self.maps_dir.name), ["7.jpg"])
+
+        with open(os.path.join(self.maps_dir.name, "7.jpg"), "rb") as file:
+            self.assertEqual(file.read(), MAP_BYTES)
+
+    def test_save_map_fail(self):
+        with patch("mapping.API_KEY", "bad"):
+            path = mapping.save_map(7, "500 Sansome St", "San Francisco", "CA")
+
+        self.assertIsNone(path)
+        self.assertEqual(os.listdir(self.maps_dir.name), [])
+
+
+class MapViewsTestCase(TestCase):
+    """Tests for serving saved maps."""
+
+    def test_show_map(self):
+        use_temp_maps_dir(self)
+        path = fake_save_map("abc123", None, None, None)
+        version = mapping.get_map_version("abc123")
+
+        self.assertEqual(path, f"/maps/abc123.jpg?v={version}")
+
+        with app.test_client() as client:
+            resp = client.get(path)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(resp.headers["ETag"], f'"{version}"')
+            resp.close()
+
+            resp = client.get(path, headers={"If-None-Match": f'"{version}"'})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            resp = client.get("/maps/nope.jpg")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_show_map_refetched(self):
+        use_temp_maps_dir(self)
+        old_path = fake_save_map("abc123", None, None, None)
+
+        # a refetched map (as by `maps regenerate --force`) gets a new URL
+        with open(os.path.join(mapping.MAPS_DIR, "abc123.jpg"), "wb") as file:
+            file.write(MAP_BYTES)
+
+        new_path = mapping.get_map_path("abc123")
+        self.assertNotEqual(new_path, old_path)
+
+        with app.test_client() as client:
+            resp = client.get(new_path)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            resp.close()
+
+            # the old URL gets the new map, but it isn't cached for good
+            resp = client.get(old_path)
+            self.assertEqual(resp.data, MAP_BYTES)
+            self.assertNotIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+            resp.close()
+
 
 #######################################
 # cities
@@ -153,6 +389,33 @@ class CityModelTestCase(TestCase):
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
+    def test_city_cache(self):
+        self.assertEqual(city_cache.get("sf").name, "San Francisco")
+
+        with count_queries() as statements:
+            self.assertEqual(list(city_cache.get_all()), ["sf"])
+        self.assertEqual(statements, [])
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+        self.assertEqual(list(city_cache.get_all()), ["oak", "sf"])
+
+        db.session.get(City, "oak").name = "Oaktown"
+        db.session.commit()
+        self.assertEqual(city_cache.get("oak").name, "Oaktown")
+
+        City.query.filter_by(code="oak").delete()
+        db.session.commit()
+        self.assertEqual(list(city_cache.get_all()), ["sf"])
+
+    def test_city_cache_rollback(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.flush()
+        self.assertIn("oak", city_cache.get_all())
+
+        db.session.rollback()
+        self.assertNotIn("oak", city_cache.get_all())
+
 
 #######################################
 # cafes
@@ -187,6 +450,30 @@ class CafeModelTestCase(TestCase):
     def test_get_city_state(self):
         self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
 
+    @patch("models.save_map", side_effect=fake_save_map)
+    def test_get_cafe_map_cached(self, save_map):
+        use_temp_maps_dir(self)
+
+        path = self.cafe.get_cafe_map()
+        self.assertEqual(path, mapping.get_map_path(self.cafe.map_key))
+        self.assertTrue(path.startswith(f"/maps/{self.cafe.map_key}.jpg?v="))
+        self.assertEqual(self.cafe.get_cafe_map(), path)
+        self.assertEqual(save_map.call_count, 1)
+
+        # a cafe at the same location shares the map
+        other = Cafe(**{**CAFE_DATA, "name": "Other Cafe"})
+        db.session.add(other)
+        self.assertEqual(other.get_cafe_map(), path)
+        self.assertEqual(save_map.call_count, 1)
+
+        # changing the location makes the saved map stale
+        self.cafe.address = "1 Market St"
+        self.assertIsNone(self.cafe.get_cached_map())
+        self.assertNotEqual(self.cafe.get_cafe_map(), path)
+        self.assertEqual(save_map.call_count, 2)
+
+        db.session.rollback()
+
 
 class CafeViewsTestCase(TestCase):
     """Tests for views on cafes."""
@@ -210,6 +497,7 @@ class CafeViewsTestCase(TestCase):
     def tearDown(self):
         """After each test, remove all cafes."""
 
+        Job.query.delete()
         Cafe.query.delete()
         City.query.delete()
         db.session.commit()
@@ -220,6 +508,91 @@ class CafeViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_list_query_count(self):
+        with app.test_client() as client:
+            with count_queries() as one_cafe:
+                client.get("/cafes")
+
+            for i in range(5):
+                db.session.add(City(code=f"c{i}", name=f"City {i}", state="CA"))
+                db.session.add(Cafe(
+                    **{**CAFE_DATA, "name": f"Cafe {i}", "city_code": f"c{i}"}))
+            db.session.commit()
+
+            with count_queries() as many_cafes:
+                resp = client.get("/cafes")
+
+            self.assertIn(b"Cafe 4", resp.data)
+            self.assertEqual(len(many_cafes), len(one_cafe))
+
+    def test_list_card_cache(self):
+        with app.test_client() as client:
+            metrics.reset()
+            client.get("/cafes")
+            resp = client.get("/cafes")
+            self.assertIn(b"Test Cafe", resp.data)
+
+            counters = metrics.snapshot()["counters"]
+            self.assertEqual(counters["fragment_cache.misses"], 1)
+            self.assertEqual(counters["fragment_cache.hits"], 1)
+
+            # editing the cafe bumps its version, so its card is re-rendered
+            cafe = db.session.get(Cafe, self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
+
+            resp = client.get("/cafes")
+            self.assertIn(b"Renamed Cafe", resp.data)
+            self.assertEqual(
+                metrics.snapshot()["counters"]["fragment_cache.misses"], 2)
+
+            # as does renaming its city, which the card shows
+            db.session.get(City, "sf").name = "San Fran"
+            db.session.commit()
+
+            resp = client.get("/cafes")
+            self.assertIn(b"San Fran, CA", resp.data)
+
+    def test_list_pages(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        for name in ["A Cafe", "B Cafe", "C Cafe"]:
+            db.session.add(Cafe(**{**CAFE_DATA, "name": name}))
+        db.session.add(
+            Cafe(**{**CAFE_DATA, "name": "Oak Cafe", "city_code": "oak"}))
+        db.session.commit()
+
+        app.config['CAFES_PER_PAGE'] = 2
+
+        try:
+            with app.test_client() as client:
+                resp = client.get("/cafes")
+                html = resp.data.decode('utf8')
+                self.assertIn("A Cafe", html)
+                self.assertIn("B Cafe", html)
+                self.assertNotIn("C Cafe", html)
+                self.assertNotIn("Prev", html)
+
+                next_url = re.search(r'href="([^"]*)">Next', html).group(1)
+                resp = client.get(next_url.replace("&amp;", "&"))
+                html = resp.data.decode('utf8')
+                self.assertIn("C Cafe", html)
+                self.assertIn("Oak Cafe", html)
+                self.assertNotIn("B Cafe", html)
+
+                prev_url = re.search(
+                    r'href="([^"]*)">&laquo; Prev', html).group(1)
+                resp = client.get(prev_url.replace("&amp;", "&"))
+                html = resp.data.decode('utf8')
+                self.assertIn("A Cafe", html)
+                self.assertIn("B Cafe", html)
+
+                resp = client.get("/cafes?city=oak")
+                html = resp.data.decode('utf8')
+                self.assertIn("Oak Cafe", html)
+                self.assertNotIn("A Cafe", html)
+        finally:
+            app.config['CAFES_PER_PAGE'] = 24
+
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
@@ -227,6 +600,151 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b"Test Cafe", resp.data)
             self.assertIn(b'testcafe.com', resp.data)
 
+    @patch("models.save_map")
+    def test_detail_map_placeholder(self, save_map):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Map is on its way", resp.data)
+
+        # the map is queued for the worker rather than fetched inline
+        save_map.assert_not_called()
+        self.assertEqual(
+            Job.query.filter_by(kind="map", target_id=self.cafe_id).count(), 1)
+
+        # once the map has failed for good, viewing the page doesn't retry it
+        Job.query.filter_by(target_id=self.cafe_id).update(
+            {"status": "failed"})
+        db.session.commit()
+
+        with app.test_client() as client:
+            client.get(f"/cafes/{self.cafe_id}")
+
+        self.assertEqual(
+            Job.query.filter_by(kind="map", target_id=self.cafe_id).count(), 1)
+
+    def test_api_cafes(self):
+        for name in ["A Cafe", "B Cafe"]:
+            db.session.add(Cafe(**{**CAFE_DATA, "name": name}))
+        db.session.commit()
+
+        app.config['CAFES_PER_PAGE'] = 2
+
+        try:
+            with app.test_client() as client:
+                resp = client.get("/api/cafes?fields=name,city")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(
+                    [set(cafe) for cafe in resp.json["cafes"]],
+                    [{"id", "name", "city"}] * 2)
+                self.assertEqual(
+                    resp.json["cafes"][0]["city"], "San Francisco")
+                self.assertIsNone(resp.json["prev"])
+
+                resp = client.get(resp.json["next"])
+                self.assertEqual(
+                    [cafe["name"] for cafe in resp.json["cafes"]],
+                    ["Test Cafe"])
+                self.assertIn("fields=name", resp.json["prev"])
+                self.assertIsNone(resp.json["next"])
+
+                resp = client.get("/api/cafes?fields=name,secret")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['CAFES_PER_PAGE'] = 24
+
+    def test_api_cafe(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.cafe_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                set(resp.json["cafe"]), {"id", *Cafe.API_FIELDS})
+            self.assertEqual(resp.json["cafe"]["name"], "Test Cafe")
+            self.assertEqual(resp.json["cafe"]["state"], "CA")
+
+            resp = client.get(f"/api/cafes/{self.cafe_id}?fields=url")
+            self.assertEqual(
+                resp.json["cafe"],
+                {"id": self.cafe_id, "url": "http://testcafe.com/"})
+
+            resp = client.get(f"/api/cafes/{self.cafe_id}?fields=id")
+            self.assertEqual(resp.json["cafe"], {"id": self.cafe_id})
+
+            resp = client.get(f"/api/cafes/{self.cafe_id}?fields=name,")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(set(resp.json["cafe"]), {"id", "name"})
+
+            resp = client.get("/api/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_api_cafes_ndjson(self):
+        for i in range(5):
+            db.session.add(Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/cafes?format=ndjson&fields=name")
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+
+            cafes = [json.loads(line) for line in resp.data.splitlines()]
+            self.assertEqual(len(cafes), 6)
+            self.assertEqual(
+                cafes[0], {"id": self.cafe_id, "name": "Test Cafe"})
+
+            resp = client.get("/api/cafes?format=ndjson&city=nowhere")
+            self.assertEqual(resp.data, b"")
+
+            # every field comes without a query per cafe (once the city
+            # cache is loaded)
+            client.get("/api/cafes?format=ndjson")
+
+            with count_queries() as all_fields:
+                client.get("/api/cafes?format=ndjson")
+
+            with count_queries() as name_only:
+                client.get("/api/cafes?format=ndjson&fields=name")
+
+            self.assertEqual(len(all_fields), len(name_only))
+
+    def test_conditional_get(self):
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template)
+
+        with template_rendered.connected_to(record, app):
+            with app.test_client() as client:
+                for url in ["/cafes", f"/cafes/{self.cafe_id}"]:
+                    resp = client.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn("public", resp.headers["Cache-Control"])
+                    self.assertIn("Cookie", resp.headers["Vary"])
+                    self.assertIsNotNone(resp.last_modified)
+                    etag = resp.headers["ETag"]
+                    self.assertTrue(etag.startswith('W/"'))
+
+                    rendered.clear()
+                    resp = client.get(url, headers={"If-None-Match": etag})
+                    self.assertEqual(resp.status_code, 304)
+                    self.assertEqual(resp.data, b"")
+                    self.assertEqual(rendered, [])
+
+                    # changing the cafe changes the page's ETag
+                    cafe = db.session.get(Cafe, self.cafe_id)
+                    cafe.description = f"New for {url}"
+                    db.session.commit()
+
+                    resp = client.get(url, headers={"If-None-Match": etag})
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertNotEqual(resp.headers["ETag"], etag)
+
+                # as does changing a city
+                etag = client.get("/cafes").headers["ETag"]
+                db.session.get(City, "sf").name = "San Fran"
+                db.session.commit()
+
+                resp = client.get("/cafes", headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+
 
 class CafeAdminViewsTestCase(TestCase):
     """Tests for add/edit views on cafes."""
@@ -250,6 +768,7 @@ class CafeAdminViewsTestCase(TestCase):
     def tearDown(self):
         """After each test, delete the cities."""
 
+        Job.query.delete()
         Cafe.query.delete()
         City.query.delete()
         db.session.commit()
@@ -265,6 +784,10 @@ class CafeAdminViewsTestCase(TestCase):
                 follow_redirects=True)
             self.assertIn(b'added', resp.data)
 
+        cafe = Cafe.query.filter_by(name="new-name").one()
+        self.assertEqual(
+            Job.query.filter_by(kind="map", target_id=cafe.id).count(), 1)
+
     def test_dynamic_cities_vocab(self):
         id = self.cafe_id
 
@@ -281,6 +804,33 @@ class CafeAdminViewsTestCase(TestCase):
             resp = client.get(f"/cafes/{id}/edit")
             self.assertRegex(resp.data.decode('utf8'), choices_pattern)
 
+    def test_city_choices_cached(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            client.get("/cafes/add")
+
+            with count_queries() as statements:
+                resp = client.get("/cafes/add")
+            self.assertIn(b"San Francisco", resp.data)
+            self.assertFalse([s for s in statements if "cities" in s])
+
+            # new and changed cities show up in the add & edit forms at once
+            db.session.add(City(code="oak", name="Oakland", state="CA"))
+            db.session.get(City, "sf").name = "San Fran"
+            db.session.commit()
+
+            for url in ["/cafes/add", f"/cafes/{id}/edit"]:
+                resp = client.get(url)
+                self.assertIn(b"Oakland", resp.data)
+                self.assertIn(b"San Fran<", resp.data)
+
+            client.post(
+                f"/cafes/{id}/edit",
+                data={**CAFE_DATA_EDIT, "city_code": "oak"})
+            resp = client.get(f"/cafes/{id}")
+            self.assertIn(b"Oakland, CA", resp.data)
+
     def test_edit(self):
         id = self.cafe_id
 
@@ -302,6 +852,372 @@ class CafeAdminViewsTestCase(TestCase):
             self.assertIn(b'Test description', resp.data)
 
 
+class CafeImportExportTestCase(TestCase):
+    """Tests for `flask cafes import` and `flask cafes export`."""
+
+    def setUp(self):
+        """Before each test, add sample city & cafe."""
+
+        Job.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        db.session.rollback()
+        Job.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def write_file(self, name, text):
+        """Write text to file name in temp dir; return its path."""
+
+        path = os.path.join(self.dir, name)
+
+        with open(path, "w", encoding="UTF-8") as file:
+            file.write(text)
+
+        return path
+
+    def test_import_csv(self):
+        path = self.write_file("cafes.csv", (
+            "name,address,city_code,description,url\n"
+            "Bulk Cafe,1 Main St,sf,First,http://bulk.com/\n"
+            "Test Cafe,500 Sansome St,sf,\"New, improved\","
+            "http://testcafe.com/\n"
+            "Bulk Cafe,1 Main St,sf,Second,http://bulk.com/\n"
+        ))
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["cafes", "import", path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Added or changed 2 cafe(s)", result.output)
+
+        # a cafe listed twice gets its last values
+        bulk = Cafe.query.filter_by(name="Bulk Cafe").one()
+        self.assertEqual(bulk.description, "Second")
+        self.assertEqual(bulk.image_url, "/static/images/default-cafe.jpg")
+        self.assertEqual(bulk.version, 1)
+
+        # there's no image to make thumbnails of
+        self.assertEqual(
+            Job.query.filter_by(kind="cafe_image", target_id=bulk.id).count(),
+            0)
+
+        # existing cafes are updated in place
+        cafe = db.session.get(Cafe, self.cafe_id)
+        self.assertEqual(cafe.description, "New, improved")
+        self.assertEqual(cafe.version, 2)
+        self.assertEqual(Cafe.query.count(), 2)
+
+        # maps are left to the worker
+        self.assertEqual(
+            {job.target_id for job in Job.query.filter_by(kind="map")},
+            {bulk.id, self.cafe_id})
+
+        # importing the same file again changes nothing
+        result = runner.invoke(args=["cafes", "import", path])
+        self.assertIn("Added or changed 0 cafe(s)", result.output)
+        self.assertEqual(Job.query.filter_by(kind="map").count(), 2)
+
+    def test_import_ndjson(self):
+        description = 'Says "hi" \\ and \t tabs'
+        path = self.write_file("cafes.ndjson", "\n".join([
+            json.dumps({**CAFE_DATA, "name": "JSON Cafe",
+                        "description": description}),
+            "",
+            json.dumps({**CAFE_DATA, "name": "Other Cafe"}),
+        ]))
+
+        result = app.test_cli_runner().invoke(args=["cafes", "import", path])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        cafe = Cafe.query.filter_by(name="JSON Cafe").one()
+        self.assertEqual(cafe.description, description)
+        self.assertEqual(cafe.image_url, CAFE_DATA["image_url"])
+        self.assertEqual(
+            Job.query.filter_by(kind="cafe_image", target_id=cafe.id).count(),
+            1)
+        self.assertEqual(Cafe.query.count(), 3)
+
+    def test_import_errors(self):
+        runner = app.test_cli_runner()
+
+        path = self.write_file("bad-header.csv", "name,secret\nCafe,x\n")
+        result = runner.invoke(args=["cafes", "import", path])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Bad CSV header", result.output)
+
+        path = self.write_file(
+            "repeated.csv", "name,name,address,city_code,description,url\n")
+        result = runner.invoke(args=["cafes", "import", path])
+        self.assertIn("repeated ['name']", result.output)
+
+        bad_files = {
+            "bad-city.ndjson": json.dumps(
+                {**CAFE_DATA, "name": "Lost Cafe", "city_code": "nowhere"}),
+            "bad-json.ndjson": "{not json",
+            "short-row.csv": (
+                "name,address,city_code,description,url\nCafe,1 Main St\n"),
+        }
+
+        for name, text in bad_files.items():
+            path = self.write_file(name, text)
+            result = runner.invoke(args=["cafes", "import", path])
+            self.assertEqual(result.exit_code, 1, name)
+            self.assertIn("Import failed", result.output)
+
+        self.assertEqual(Cafe.query.count(), 1)
+
+    def test_export(self):
+        runner = app.test_cli_runner()
+
+        csv_path = os.path.join(self.dir, "cafes.csv")
+        result = runner.invoke(args=["cafes", "export", csv_path])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        with open(csv_path, encoding="UTF-8") as file:
+            lines = file.read().splitlines()
+        self.assertEqual(
+            lines[0], "name,description,url,address,city_code,image_url")
+        self.assertTrue(lines[1].startswith("Test Cafe,Test description,"))
+
+        ndjson_path = os.path.join(self.dir, "cafes.ndjson")
+        runner.invoke(args=["cafes", "export", ndjson_path])
+
+        with open(ndjson_path, encoding="UTF-8") as file:
+            cafes = [json.loads(line) for line in file]
+        self.assertEqual(cafes, [{
+            field: CAFE_DATA[field] for field in
+            ["name", "description", "url", "address", "city_code",
+             "image_url"]
+        }])
+
+        # an export can be imported again
+        Cafe.query.delete()
+        db.session.commit()
+
+        for path in [csv_path, ndjson_path]:
+            result = runner.invoke(args=["cafes", "import", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(Cafe.query.count(), 1)
+
+
+class WorkerTestCase(TestCase):
+    """Tests for running background jobs."""
+
+    def setUp(self):
+        """Before each test, add sample city and cafe with a queued map."""
+
+        Job.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.flush()
+
+        self.job = Job.enqueue("map", cafe.id)
+        db.session.commit()
+
+        self.cafe = cafe
+
+    def tearDown(self):
+        """After each test, remove all jobs and cafes."""
+
+        Job.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_enqueue_dedupes(self):
+        self.assertEqual(Job.enqueue("map", self.cafe.id), self.job)
+
+    @patch("models.save_map", side_effect=fake_save_map)
+    def test_run_map_job(self, save_map):
+        use_temp_maps_dir(self)
+
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(self.job.status, "done")
+        self.assertEqual(self.cafe.map_key, self.cafe.get_map_key())
+
+    @patch("models.save_map", return_value=None)
+    def test_run_map_job_retries(self, save_map):
+        use_temp_maps_dir(self)
+
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(self.job.status, "pending")
+        self.assertEqual(self.job.attempts, 1)
+
+        # not due again until the backoff has passed
+        self.assertEqual(run_pending_jobs(), 0)
+
+        self.job.attempts = MAX_ATTEMPTS - 1
+        self.job.run_at = datetime.utcnow()
+        db.session.commit()
+
+        run_pending_jobs()
+        self.assertEqual(self.job.status, "failed")
+
+    def test_regenerate_maps(self):
+        use_temp_maps_dir(self)
+
+        same = Cafe(**{**CAFE_DATA, "name": "Same Place Cafe"})
+        other = Cafe(**{**CAFE_DATA, "address": "1 Market St"})
+        cafes = [self.cafe, same, other]
+        db.session.add_all(cafes)
+
+        with patch("worker.save_map", side_effect=fake_save_map) as save_map:
+            self.assertEqual(
+                regenerate_maps(cafes, workers=2, rate=100), (2, 0))
+
+            # one fetch per distinct location
+            self.assertEqual(save_map.call_count, 2)
+            self.assertEqual(self.cafe.map_key, same.map_key)
+            self.assertEqual(other.map_key, other.get_map_key())
+
+            # maps already saved aren't refetched
+            self.assertEqual(
+                regenerate_maps(cafes, workers=2, rate=100), (0, 0))
+            self.assertEqual(save_map.call_count, 2)
+
+        db.session.rollback()
+
+    @patch("worker.save_map", return_value=None)
+    def test_regenerate_maps_fail(self, save_map):
+        use_temp_maps_dir(self)
+
+        self.assertEqual(
+            regenerate_maps([self.cafe], workers=1, rate=100), (0, 1))
+        self.assertIsNone(self.cafe.map_key)
+
+    def test_collect_map_garbage(self):
+        use_temp_maps_dir(self)
+
+        fake_save_map(self.cafe.get_map_key(), None, None, None)
+        self.cafe.map_key = self.cafe.get_map_key()
+        db.session.commit()
+
+        fake_save_map("unused", None, None, None)
+        fake_save_map("new", None, None, None)
+
+        old = time.time() - 120
+        for map_key in [self.cafe.map_key, "unused"]:
+            path = os.path.join(mapping.MAPS_DIR, f"{map_key}.jpg")
+            os.utime(path, (old, old))
+
+        self.assertEqual(collect_map_garbage(min_age=60), 1)
+        self.assertEqual(
+            sorted(os.listdir(mapping.MAPS_DIR)),
+            sorted([f"{self.cafe.map_key}.jpg", "new.jpg"]))
+
+
+    def test_backfill_thumbnails(self):
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["images", "backfill"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("for 1 cafe(s)", result.output)
+        self.assertEqual(
+            Job.query.filter_by(kind="cafe_image", target_id=self.cafe.id)
+            .count(),
+            1)
+
+        # jobs already pending aren't queued again
+        result = runner.invoke(args=["images", "backfill"])
+        self.assertIn("for 0 cafe(s)", result.output)
+
+        # nor are cafes with current thumbnails, or the default image
+        Job.query.filter_by(kind="cafe_image").delete()
+        self.cafe.image_key = get_image_key(self.cafe.image_url)
+        db.session.add(Cafe(**{
+            **CAFE_DATA, "name": "Plain Cafe", "image_url": None}))
+        db.session.commit()
+
+        result = runner.invoke(args=["images", "backfill"])
+        self.assertIn("for 0 cafe(s)", result.output)
+
+
+class LRUCacheTestCase(TestCase):
+    """Tests for the in-process LRU cache."""
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "3")
+
+
+class TokenBucketTestCase(TestCase):
+    """Tests for the token bucket rate limiter."""
+
+    def test_take(self):
+        bucket = TokenBucket(rate=1, capacity=2)
+
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertGreater(bucket.take(), 0)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=1, capacity=1, maxsize=2)
+
+        self.assertEqual(limiter.take("a"), 0)
+        self.assertGreater(limiter.take("a"), 0)
+
+        # each key has its own bucket
+        self.assertEqual(limiter.take("b"), 0)
+
+        # least recently used bucket is dropped past maxsize
+        self.assertEqual(limiter.take("c"), 0)
+        self.assertEqual(limiter.take("a"), 0)
+
+
+class PasswordHasherTestCase(TestCase):
+    """Tests for hashing passwords in a pool of processes."""
+
+    def test_process_pool(self):
+        pool_hasher = PasswordHasher(workers=1, queue_depth=0, rounds=4)
+
+        try:
+            hashed = pool_hasher.hash("secret")
+            self.assertTrue(hashed.startswith("$2b$04$"))
+            self.assertTrue(pool_hasher.check(hashed, "secret"))
+            self.assertFalse(pool_hasher.check(hashed, "WRONG"))
+        finally:
+            pool_hasher.shutdown()
+
+    def test_saturated(self):
+        full_hasher = PasswordHasher(workers=0, queue_depth=0)
+        metrics.reset()
+
+        with self.assertRaises(PoolSaturated):
+            full_hasher.hash("secret")
+
+        self.assertEqual(
+            metrics.snapshot()["counters"]["passwords.saturated"], 1)
+
+
 #######################################
 # users
 
@@ -331,6 +1247,26 @@ class UserModelTestCase(TestCase):
         rez = User.authenticate("test", "secret")
         self.assertEqual(rez, self.user)
 
+    def test_rehash_on_login(self):
+        self.assertTrue(self.user.hashed_password.startswith("$2b$04$"))
+
+        hasher = app.extensions['password_hasher']
+        rounds = hasher.rounds
+        hasher.rounds = 5
+
+        try:
+            # a wrong password never changes the hash
+            User.authenticate("test", "WRONG")
+            self.assertTrue(self.user.hashed_password.startswith("$2b$04$"))
+
+            User.authenticate("test", "secret")
+            self.assertTrue(self.user.hashed_password.startswith("$2b$05$"))
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        self.assertEqual(User.authenticate("test", "secret"), self.user)
+
     def test_authenticate_fail(self):
         rez = User.authenticate("no-such-user", "secret")
         self.assertFalse(rez)
@@ -341,6 +1277,53 @@ class UserModelTestCase(TestCase):
     def test_full_name(self):
         self.assertEqual(self.user.get_full_name(), "Testy MacTest")
 
+    def test_thumbnails(self):
+        thumbs_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(thumbs_dir.cleanup)
+
+        self.assertEqual(self.user.get_image("detail"), DEFAULT_USER_IMAGE_URL)
+
+        with patch("images.THUMBS_DIR", thumbs_dir.name):
+            self.assertTrue(self.user.make_thumbnails())
+
+        self.assertEqual(
+            self.user.get_image("list"),
+            f"/static/thumbs/{self.user.image_key}-list.webp")
+
+        with Image.open(os.path.join(
+                thumbs_dir.name, f"{self.user.image_key}-list.webp")) as thumb:
+            self.assertEqual(thumb.format, "WEBP")
+            self.assertLessEqual(thumb.width, THUMB_SIZES["list"][0])
+            self.assertLessEqual(thumb.height, THUMB_SIZES["list"][1])
+
+        # a new image means the thumbnails are out of date
+        self.user.image_url = "http://new-image.com"
+        self.assertEqual(self.user.get_image("list"), "http://new-image.com")
+        db.session.rollback()
+
+    def test_thumbnails_internal_url(self):
+        for url in ("http://169.254.169.254/latest/meta-data/",
+                    "http://localhost:5432/",
+                    "http://10.0.0.1/cafe.jpg",
+                    "file:///etc/passwd"):
+            with self.subTest(url=url), patch("images.http.get") as get:
+                self.assertRaises(ValueError, read_image, url)
+                get.assert_not_called()
+
+        # a public host can't redirect to an internal one, either
+        redirect = MagicMock(is_redirect=True)
+        redirect.__enter__.return_value = redirect
+        redirect.headers = {"location": "http://127.0.0.1/admin"}
+        public = [(None, None, None, "", ("93.184.215.14", 80))]
+        loopback = [(None, None, None, "", ("127.0.0.1", 80))]
+
+        with patch("images.socket.getaddrinfo",
+                   side_effect=[public, loopback]), \
+                patch("images.http.get", return_value=redirect) as get:
+            self.assertRaises(
+                ValueError, read_image, "http://cafe.example.com/a.jpg")
+            get.assert_called_once()
+
     def test_register(self):
         u = User.register(**TEST_USER_DATA)
         # test that password gets bcrypt-hashed (all start w/$2b$)
@@ -419,6 +1402,67 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"Hello, test", resp.data)
             self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
 
+    def test_login_throttled(self):
+        hasher = app.extensions['password_hasher']
+        limiters = {"username": RateLimiter(rate=0.001, capacity=2)}
+
+        with app.test_client() as client, \
+                patch.dict(app.extensions['login_limiters'], limiters), \
+                patch.object(hasher, "check", wraps=hasher.check) as check:
+            metrics.reset()
+
+            for _ in range(2):
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "WRONG"})
+                self.assertEqual(resp.status_code, 302)
+
+            # throttled before the password is even checked
+            resp = client.post(
+                "/login", data={"username": "TEST", "password": "secret"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertEqual(check.call_count, 2)
+            self.assertEqual(
+                metrics.snapshot()["counters"]["login.throttled.username"], 1)
+
+            # other usernames can still log in
+            resp = client.post(
+                "/login", data={"username": "other", "password": "secret"})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_login_throttled_behind_proxy(self):
+        class ProxiedConfig(TestingConfig):
+            TRUSTED_PROXIES = 1
+
+        proxied_app = create_app(ProxiedConfig)
+        proxied_app.extensions['login_limiters']["ip"] = RateLimiter(
+            rate=0.001, capacity=1)
+
+        def log_in(client_ip):
+            return proxied_app.test_client().post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+                headers={"X-Forwarded-For": client_ip},
+            )
+
+        # each client behind the proxy has its own bucket
+        self.assertEqual(log_in("10.0.0.1").status_code, 302)
+        self.assertEqual(log_in("10.0.0.2").status_code, 302)
+        self.assertEqual(log_in("10.0.0.1").status_code, 429)
+
+    def test_login_saturated(self):
+        with app.test_client() as client:
+            with patch.object(app.extensions['password_hasher'], "check",
+                              side_effect=PoolSaturated):
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
     def test_logout(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -456,6 +1500,19 @@ class NavBarTestCase(TestCase):
             self.assertIn(b"Log In", resp.data)
             self.assertIn(b"Sign Up", resp.data)
 
+    def test_navbar_user_cached_in_session(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/profile")
+            self.assertIn(b"Testy MacTest", resp.data)
+
+            with count_queries() as statements:
+                resp = client.get("/login")
+
+            self.assertIn(b"Testy MacTest", resp.data)
+            self.assertEqual(statements, [])
+
     def test_logged_in_navbar(self):
         with app.test_client() as client:
             resp = client.post(
@@ -548,22 +1605,30 @@ class LikeViewsTestCase(CafeViewsTestCase):
 
         self.user_id = user.id
 
-        l1 = Like(
-            user_id=self.user_id,
-            cafe_id=self.cafe_id
-        )
-
-        db.session.add(l1)
+        Like.add(self.user_id, self.cafe_id)
 
         db.session.commit()
 
     def tearDown(self):
         """After each test, remove all users."""
 
+        Job.query.delete()
         Cafe.query.delete()
         User.query.delete()
         db.session.commit()
 
+    def test_logged_in_not_cached(self):
+        with app.test_client() as client:
+            etag = client.get("/cafes").headers["ETag"]
+
+            login_for_test(client, self.user_id)
+
+            for url in ["/cafes", f"/cafes/{self.cafe_id}"]:
+                resp = client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("ETag", resp.headers)
+                self.assertIn("no-store", resp.headers["Cache-Control"])
+
     def test_user_show_likes(self):
         with app.test_client() as client:
 
@@ -580,3 +1645,98 @@ class LikeViewsTestCase(CafeViewsTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Liked Cafes", resp.data)
             self.assertIn(b"Test Cafe", resp.data)
+
+    def test_detail_shows_liked(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Liked", resp.data)
+
+    def test_is_liked_api(self):
+        with app.test_client() as client:
+            resp = client.get(
+                f"/api/likes?userId={self.user_id}&cafeId={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+
+            resp = client.get(f"/api/likes?userId={self.user_id}&cafeId=0")
+            self.assertEqual(resp.json, {"likes": False})
+
+    def test_like_unlike_idempotent(self):
+        data = {"userId": self.user_id, "cafeId": self.cafe_id}
+
+        with app.test_client() as client:
+            resp = client.post("/api/unlike", json=data)
+            self.assertEqual(resp.json["likes"], False)
+            resp = client.post("/api/unlike", json=data)
+            self.assertEqual(resp.json["likes"], False)
+            self.assertFalse(Like.is_liked(self.user_id, self.cafe_id))
+
+            resp = client.post("/api/like", json=data)
+            self.assertEqual(resp.json["likes"], True)
+            resp = client.post("/api/like", json=data)
+            self.assertEqual(resp.json["likes"], True)
+            self.assertTrue(Like.is_liked(self.user_id, self.cafe_id))
+
+    def test_toggle_like(self):
+        data = {"cafeId": self.cafe_id}
+
+        with app.test_client() as client:
+            resp = client.post("/api/likes/toggle", json=data)
+            self.assertEqual(resp.status_code, 401)
+            self.assertTrue(Like.is_liked(self.user_id, self.cafe_id))
+
+            login_for_test(client, self.user_id)
+
+            # the user is always the logged-in one, whatever the body says
+            resp = client.post(
+                "/api/likes/toggle", json={**data, "userId": 0})
+            self.assertEqual(resp.json, {"likes": False, "likeCount": 0})
+
+            resp = client.post("/api/likes/toggle", json=data)
+            self.assertEqual(resp.json, {"likes": True, "likeCount": 1})
+
+    def test_like_count(self):
+        data = {"userId": self.user_id, "cafeId": self.cafe_id}
+        cafe = db.session.get(Cafe, self.cafe_id)
+
+        self.assertEqual(cafe.like_count, 1)
+
+        with app.test_client() as client:
+            client.post("/api/unlike", json=data)
+            client.post("/api/unlike", json=data)
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.like_count, 0)
+
+            client.post("/api/like", json=data)
+            client.post("/api/like", json=data)
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.like_count, 1)
+
+    def test_recount_likes(self):
+        cafe = db.session.get(Cafe, self.cafe_id)
+        cafe.like_count = 10
+        db.session.commit()
+        updated_at = cafe.updated_at
+
+        self.assertEqual(Cafe.recount_likes(), 1)
+        db.session.commit()
+        self.assertEqual(cafe.like_count, 1)
+
+        # pages show the count, so their Last-Modified must move too
+        self.assertGreater(cafe.updated_at, updated_at)
+
+    def test_list_most_liked(self):
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "A Unloved Cafe"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get("/cafes?sort=likes").data.decode('utf8')
+            self.assertLess(
+                html.index("Test Cafe"), html.index("A Unloved Cafe"))
+
+    def test_like_missing_cafe(self):
+        with app.test_client() as client:
+            resp = client.post(
+                "/api/like", json={"userId": self.user_id, "cafeId": 0})
+            self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,255 @@
+"""Background worker for Flask Cafe jobs.
+
+Run with:
+
+    flask --app app worker
+
+Any number of workers can run at once; each job is claimed with
+SELECT ... FOR UPDATE SKIP LOCKED so it is only run by one of them.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import os
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from images import get_image_key
+from mapping import list_maps, map_exists, save_map
+from models import db, Cafe, Job, User
+from ratelimit import TokenBucket
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2
+MAX_BACKOFF = 300
+POLL_INTERVAL = 1
+
+
+class JobError(Exception):
+    """A job ran but did not succeed, and should be retried."""
+
+
+#######################################
+# job handlers
+
+
+def render_cafe_map(cafe_id):
+    """Fetch and save the map for this cafe, if it isn't already current."""
+
+    cafe = db.session.get(Cafe, cafe_id)
+
+    # cafe may have been deleted since the job was queued
+    if cafe is None:
+        return
+
+    if not cafe.get_cafe_map():
+        raise JobError(f"Could not get map for cafe #{cafe_id}")
+
+
+def render_thumbnails(model, id):
+    """Make thumbnails of the image of this cafe or user."""
+
+    obj = db.session.get(model, id)
+
+    if obj is None:
+        return
+
+    if not obj.make_thumbnails():
+        raise JobError(f"Could not make thumbnails for {obj}")
+
+
+JOB_HANDLERS = {
+    "map": render_cafe_map,
+    "cafe_image": lambda cafe_id: render_thumbnails(Cafe, cafe_id),
+    "user_image": lambda user_id: render_thumbnails(User, user_id),
+}
+
+
+def regenerate_maps(cafes, workers, rate, force=False):
+    """Fetch maps for these cafes concurrently, in a pool of workers
+    threads making at most rate MapQuest requests per second.
+
+    Each distinct location is fetched once, and only if its map hasn't
+    been saved already (unless force). Updates each cafe's map_key (caller
+    commits).
+
+    Returns (number of maps saved, number that failed).
+    """
+
+    # only the threads touch the network, and only this thread the db
+    locations = {}
+    cafes_by_key = defaultdict(list)
+
+    for cafe in cafes:
+        map_key = cafe.get_map_key()
+
+        if force or not map_exists(map_key):
+            city = cafe.city
+            locations[map_key] = (cafe.address, city.name, city.state)
+
+        cafes_by_key[map_key].append(cafe)
+
+    limiter = TokenBucket(rate)
+
+    def fetch(map_key, address, city, state):
+        limiter.wait()
+        return save_map(map_key, address, city, state)
+
+    saved = failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetch, map_key, *location): map_key
+            for map_key, location in locations.items()
+        }
+
+        for future in as_completed(futures):
+            try:
+                path = future.result()
+            except Exception:
+                path = None
+
+            if path:
+                saved += 1
+            else:
+                failed += 1
+
+    for map_key, key_cafes in cafes_by_key.items():
+        if map_exists(map_key):
+            for cafe in key_cafes:
+                cafe.map_key = map_key
+
+    return saved, failed
+
+
+def collect_map_garbage(min_age=3600):
+    """Delete saved maps no cafe refers to. Returns number deleted.
+
+    Skips maps changed in the last min_age seconds, which may be new maps
+    whose cafes haven't been committed yet.
+    """
+
+    referenced = set(db.session.scalars(
+        db.select(Cafe.map_key).where(Cafe.map_key.is_not(None)).distinct()))
+
+    cutoff = time.time() - min_age
+    count = 0
+
+    for map_key, path in list_maps():
+        if map_key not in referenced and os.path.getmtime(path) < cutoff:
+            os.unlink(path)
+            count += 1
+
+    return count
+
+
+def queue_thumbnails():
+    """Queue thumbnail jobs for every cafe and user whose thumbnails aren't
+    current (such as those added before there were thumbnails).
+
+    Returns (number of cafe jobs, number of user jobs) queued. Caller
+    commits.
+    """
+
+    counts = []
+
+    for kind, model in (("cafe_image", Cafe), ("user_image", User)):
+        query = db.select(model.id, model.image_url, model.image_key).where(
+            model.image_url.is_not(None))
+
+        # the default cafe image isn't there to fetch (see bulk.py)
+        if model is Cafe:
+            query = query.where(Cafe.image_url != Cafe.image_url.default.arg)
+
+        rows = db.session.execute(query.execution_options(yield_per=1000))
+
+        counts.append(Job.enqueue_many(kind, [
+            id for id, image_url, image_key in rows
+            if image_key != get_image_key(image_url)
+        ]))
+
+    return tuple(counts)
+
+
+#######################################
+# running jobs
+
+
+def get_backoff(attempts):
+    """Return seconds to wait before retrying a job after this many tries."""
+
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def claim_job():
+    """Lock and return the next due job, or None if there isn't one."""
+
+    return (Job.query
+            .filter(Job.status == "pending", Job.run_at <= datetime.utcnow())
+            .order_by(Job.run_at)
+            .with_for_update(skip_locked=True)
+            .first())
+
+
+def run_job(job):
+    """Run job, then mark it done or schedule a retry with backoff.
+
+    Caller commits (which also releases the lock taken by claim_job).
+    """
+
+    try:
+        # a savepoint, so a failing handler doesn't lose our lock on the job
+        with db.session.begin_nested():
+            JOB_HANDLERS[job.kind](job.target_id)
+
+    except Exception as exc:
+        job.attempts += 1
+        job.last_error = str(exc)
+
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = "failed"
+        else:
+            job.run_at = (datetime.utcnow()
+                          + timedelta(seconds=get_backoff(job.attempts)))
+
+        return False
+
+    job.status = "done"
+
+    return True
+
+
+def run_pending_jobs():
+    """Run every job that is currently due. Return number of jobs run."""
+
+    count = 0
+
+    while (job := claim_job()):
+        run_job(job)
+        db.session.commit()
+        count += 1
+
+    db.session.commit()
+
+    return count
+
+
+@click.command("worker")
+@click.option("--once", is_flag=True, help="Run due jobs, then exit.")
+@with_appcontext
+def worker_command(once):
+    """Run background jobs (like rendering cafe maps)."""
+
+    while True:
+        count = run_pending_jobs()
+
+        if count:
+            click.echo(f"Ran {count} job(s).")
+
+        if once:
+            break
+
+        time.sleep(POLL_INTERVAL)